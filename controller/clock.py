@@ -0,0 +1,21 @@
+# The time Part4Controller's tables go by
+#
+# wall-clock time, except while recorder.py replays a recording: then it
+# is the timestamp of the message being replayed, so that timeouts,
+# connection lifetimes and heavy-hitter windows decide as they did when
+# the recording was made
+
+import time
+
+_source = time.time
+
+
+def now():
+    return _source()
+
+
+# make now() return source() (a function of no arguments); None goes
+# back to the wall clock
+def use(source=None):
+    global _source
+    _source = time.time if source is None else source
@@ -0,0 +1,199 @@
+# Cluster mode for Part4Controller
+#
+# several controller processes, all connected to every switch, share
+# what they learn through a store; each switch is mastered by exactly
+# one live instance connected to it, picked by rendezvous hashing over
+# the dpid, so an instance dying (or losing a switch) moves only its own
+# switches, to the others
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class DictStore (object):
+    """
+    An in-process stand-in for a shared store, for tests: nothing
+    outside this process sees it.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._data.get(key, default)
+
+    def put_many(self, items):
+        with self._lock:
+            self._data.update(items)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def items(self, prefix):
+        with self._lock:
+            return [(k, v) for k, v in self._data.items()
+                    if k.startswith(prefix)]
+
+
+class SQLiteStore (object):
+    """
+    A key/value table in a SQLite file that instances on the same host
+    share; values are stored as JSON.
+    """
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, timeout=5, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS kv "
+                         "(key TEXT PRIMARY KEY, value TEXT)")
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM kv WHERE key = ?",
+                                   (key,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    # one transaction for all of items (key, value)
+    def put_many(self, items):
+        rows = [(k, json.dumps(v)) for k, v in dict(items).items()]
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany("INSERT OR REPLACE INTO kv VALUES (?, ?)",
+                                     rows)
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def delete(self, key):
+        with self._lock:
+            self._db.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def items(self, prefix):
+        # keys starting with prefix sort in [prefix, prefix + U+FFFF)
+        with self._lock:
+            rows = self._db.execute("SELECT key, value FROM kv "
+                                    "WHERE key >= ? AND key < ?",
+                                    (prefix, prefix + '\uffff')).fetchall()
+        return [(k, json.loads(v)) for k, v in rows]
+
+
+def _weight(member, dpid):
+    h = hashlib.md5(('%s/%s' % (member, dpid)).encode()).hexdigest()
+    return int(h[:16], 16)
+
+
+class Cluster (object):
+    """
+    Membership, mastership and shared state of one instance.
+
+    Instances heartbeat into the store every tick, along with the
+    switches they are connected to; one that hasn't for ttl seconds is
+    gone, and the switches it mastered go to whichever live instance
+    connected to them now weighs most for them.  Shared writes are
+    buffered and written in one transaction per tick, off the PacketIn
+    path.
+    """
+
+    def __init__(self, store, member, ttl=3.0):
+        self.store = store
+        self.member = str(member)
+        self.ttl = ttl
+        self._members = [self.member]
+        self._dpids = set()                 # switches connected here
+        self._connected = {}                # map: dpid to members connected
+        self._pending = {}                  # writes for the next tick
+        self._lock = threading.Lock()
+
+    # heartbeat, flush shared writes, refresh the member list and who is
+    # connected to what; returns True if the members changed
+    def tick(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            dpids = list(self._dpids)
+        pending['member/' + self.member] = now
+        for d in dpids:
+            pending['conn/%s/%s' % (d, self.member)] = now
+        self.store.put_many(pending)
+        alive = sorted(k[len('member/'):] for k, t in self.store.items('member/')
+                       if now - t <= self.ttl)
+        if self.member not in alive:
+            alive = sorted(alive + [self.member])
+        connected = {}
+        for k, t in self.store.items('conn/'):
+            dpid, member = k[len('conn/'):].split('/', 1)
+            if now - t <= self.ttl and member in alive:
+                connected.setdefault(dpid, set()).add(member)
+        changed = alive != self._members
+        self._members = alive
+        self._connected = connected
+        return changed
+
+    def members(self):
+        return list(self._members)
+
+    # dpid connected to (or disconnected from) this instance
+    def connected(self, dpid):
+        with self._lock:
+            self._dpids.add(dpid)
+
+    def disconnected(self, dpid):
+        with self._lock:
+            self._dpids.discard(dpid)
+        self.store.delete('conn/%s/%s' % (dpid, self.member))
+
+    # the live member connected to dpid that masters it, None if none is
+    def master(self, dpid):
+        able = set(self._connected.get(str(dpid), ())) & set(self._members)
+        with self._lock:
+            if dpid in self._dpids:
+                able.add(self.member)
+            else:
+                able.discard(self.member)
+        if not able:
+            return None
+        return max(sorted(able), key=lambda m: _weight(m, dpid))
+
+    def is_master(self, dpid):
+        return self.master(dpid) == self.member
+
+    def leave(self):
+        with self._lock:
+            dpids = list(self._dpids)
+        for d in dpids:
+            self.store.delete('conn/%s/%s' % (d, self.member))
+        self.store.delete('member/' + self.member)
+
+    # learned hosts of dpid: share one, read them all back
+    def share_host(self, dpid, ip, mac, port):
+        with self._lock:
+            self._pending['host/%s/%s' % (dpid, ip)] = [str(mac), port]
+
+    def hosts(self, dpid):
+        prefix = 'host/%s/' % (dpid,)
+        with self._lock:
+            pending = [(k, v) for k, v in self._pending.items()
+                       if k.startswith(prefix)]
+        out = dict(self.store.items(prefix))
+        out.update(pending)
+        return dict((k[len(prefix):], tuple(v)) for k, v in out.items())
+
+    # the policy in force cluster-wide, with a version to spot changes
+    def share_policy(self, policy):
+        version = self.store.get('policy/version', 0) + 1
+        self.store.put_many({'policy': policy, 'policy/version': version})
+        return version
+
+    def policy(self):
+        return self.store.get('policy/version', 0), self.store.get('policy')
@@ -0,0 +1,136 @@
+# Connection tracking for Part4Controller
+#
+# the controller sees the first packet of every connection through
+# cores21; we remember it here as a 5-tuple, decide once whether the
+# connection is allowed, and let the switch carry the rest of it in
+# both directions
+
+from collections import OrderedDict
+
+import clock
+
+# connection states
+NEW = 'new'                 # first packet seen, not yet offloaded
+ESTABLISHED = 'est'         # flows installed both ways
+DENIED = 'denied'           # refused by policy
+
+ICMP = 1
+
+
+# the 5-tuple of an IPv4 packet (IPv4 header object), as tracked here
+def five_tuple(ip):
+    t = ip.next
+    if ip.protocol == ICMP or not hasattr(t, 'srcport'):
+        return (ip.protocol, ip.srcip, ip.dstip, 0, 0)
+    return (ip.protocol, ip.srcip, ip.dstip, t.srcport, t.dstport)
+
+
+# the 5-tuple a flow match (as built by ofp_match.from_packet) covers
+def match_tuple(m):
+    if m.nw_proto == ICMP or m.tp_src is None:
+        return (m.nw_proto, m.nw_src, m.nw_dst, 0, 0)
+    return (m.nw_proto, m.nw_src, m.nw_dst, m.tp_src, m.tp_dst)
+
+
+# the same connection, seen from the other end
+def reverse(key):
+    return (key[0], key[2], key[1], key[4], key[3])
+
+
+class Connection (object):
+    __slots__ = ('key', 'state', 'first', 'last', 'flows')
+
+    def __init__(self, key, state, now):
+        self.key = key          # 5-tuple of the side that opened it
+        self.state = state
+        self.first = now
+        self.last = now
+        self.flows = 0          # its flows installed on the switch
+
+
+class ConnTrack (object):
+    """
+    A bounded table of connections, indexed by both of their 5-tuples.
+
+    reply_only holds addresses that may answer connections opened by
+    others, but may not open any of their own.  The table never grows
+    past max_entries connections; the least recently used ones are
+    forgotten first (their flows, if any, keep working on the switch).
+    """
+
+    def __init__(self, reply_only=(), max_entries=32768, timeout=300):
+        self.reply_only = set(reply_only)
+        self.max_entries = max_entries
+        self.timeout = timeout              # lifetime of an entry once
+                                            # it has no flows left
+        self._table = OrderedDict()         # map: 5-tuple to Connection
+        self._count = 0                     # connections (not keys) held
+
+    # may key open a new connection?
+    def allowed(self, key):
+        return key[1] not in self.reply_only
+
+    # look up the connection a packet belongs to, creating it if new;
+    # returns (connection, True if the packet travels in reply direction)
+    def track(self, key, now=None):
+        now = clock.now() if now is None else now
+        c = self._table.get(key)
+        # an offloaded connection sends no PacketIns, however busy: its
+        # flows being there is what keeps it alive
+        if c is not None and c.flows <= 0 and now - c.last > self.timeout:
+            self.forget(key)
+            c = None
+        if c is None:
+            c = Connection(key, NEW if self.allowed(key) else DENIED, now)
+            self._table[key] = c
+            self._table[reverse(key)] = c
+            self._count += 1
+            while self._count > self.max_entries:
+                self._evict()
+        else:
+            self._table.move_to_end(key)
+            self._table.move_to_end(reverse(key))
+            c.last = now
+        return c, c.key != key
+
+    # the connection key belongs to is gone (e.g. its flows expired)
+    def forget(self, key):
+        c = self._table.pop(key, None)
+        if c is None:
+            return None
+        self._table.pop(reverse(key), None)
+        self._count -= 1
+        return c
+
+    # a flow matching key was installed
+    def flow_added(self, key):
+        c = self._table.get(key)
+        if c is not None:
+            c.flows += 1
+
+    # a flow matching key is gone; once both directions' flows are, so
+    # is the connection (the other one may still be carrying replies)
+    def flow_removed(self, key):
+        c = self._table.get(key)
+        if c is None:
+            return
+        c.flows -= 1
+        c.last = clock.now()                # was carrying traffic till now
+        if c.flows <= 0:
+            self.forget(key)
+
+    def _evict(self):
+        key, c = next(iter(self._table.items()))
+        self.forget(key)
+
+    # connections per state; copies the table first, as introspect.py
+    # calls this from its own thread
+    def states(self):
+        n = {}
+        for key, c in list(self._table.items()):
+            if key == c.key:
+                n[c.state] = n.get(c.state, 0) + 1
+        return n
+
+    def __len__(self):
+        return self._count
@@ -0,0 +1,72 @@
+# Adaptive idle timeouts for the flows learned by Part4Controller
+#
+# every flow used to get idle_timeout=10; instead we keep a little
+# history per (src, dst) pair, fed by the switch's FlowRemoved stats,
+# and stretch or shrink the timeout depending on how the pair behaves
+
+from collections import OrderedDict
+
+import clock
+
+
+class AdaptiveTimeout (object):
+    """
+    Picks the idle timeout for a new flow from the history of its pair.
+
+    A pair that comes back shortly after its flow expired gets a longer
+    timeout next time; a flow that expired having carried only a packet
+    or two (a one-shot "mouse") gets a shorter one.
+    """
+
+    def __init__(self, default=10, low=2, high=120, mouse=2,
+                 window=None, max_pairs=4096):
+        self.default = default
+        self.low = low                      # never go below this
+        self.high = high                    # ... nor above this
+        self.mouse = mouse                  # packets <= mouse is one-shot
+        self.window = window                # back within window = returning
+        self.max_pairs = max_pairs          # bound the history size
+        # map: (src, dst) to [timeout, last removed at, times returned]
+        self._history = OrderedDict()
+
+    # idle timeout to use for a flow from src to dst that we install now
+    def timeout(self, src, dst, now=None):
+        key = (src, dst)
+        h = self._history.get(key)
+        if h is None:
+            return self.default
+        self._history.move_to_end(key)
+        now = clock.now() if now is None else now
+        window = self.window if self.window is not None else 2 * h[0]
+        if h[1] is not None and now - h[1] <= window:
+            # flow came back soon after it expired, keep it around longer
+            h[0] = min(self.high, h[0] * 2)
+            h[2] += 1
+        h[1] = None
+        return h[0]
+
+    # is this pair being re-installed shortly after its flow expired?
+    def returning(self, src, dst, now=None):
+        h = self._history.get((src, dst))
+        if h is None or h[1] is None:
+            return False
+        now = clock.now() if now is None else now
+        window = self.window if self.window is not None else 2 * h[0]
+        return now - h[1] <= window
+
+    # feed the stats of an expired flow back into the history
+    def removed(self, src, dst, timeout, packets, now=None):
+        key = (src, dst)
+        h = self._history.get(key)
+        if h is None:
+            h = self._history[key] = [timeout or self.default, None, 0]
+            if len(self._history) > self.max_pairs:
+                self._history.popitem(last=False)   # forget the oldest
+        else:
+            self._history.move_to_end(key)
+        if packets <= self.mouse:
+            h[0] = max(self.low, h[0] // 2)         # one-shot, let it go
+        h[1] = clock.now() if now is None else now
+
+    def __len__(self):
+        return len(self._history)
@@ -0,0 +1,90 @@
+# Live introspection of Part4Controller over HTTP/JSON
+#
+# a small HTTP server on its own thread answers GET /<view>[?dpid=N]
+# with what the view's function returns, as JSON; views only copy the
+# controller's tables (one C-level copy each, atomic under the GIL) and
+# format the copy here, so a query never takes a lock the PacketIn
+# path would have to wait for
+
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+
+class _Server (ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class IntrospectionServer (object):
+    """
+    Serves views, a map from name to a function of a dpid (None for all
+    switches) returning something json can dump (str() for the rest).
+    """
+
+    def __init__(self, views, port=8081, host='127.0.0.1'):
+        self.views = dict(views)
+        self.requests = 0
+        server = self
+
+        class Handler (BaseHTTPRequestHandler):
+            def do_GET(self):
+                server._answer(self)
+
+            def log_message(self, *args):
+                pass                            # not per request
+
+        self._httpd = _Server((host, port), Handler)
+        self.address = self._httpd.server_address
+        self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                        name='introspect')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _answer(self, req):
+        self.requests += 1
+        url = urlparse(req.path)
+        name = url.path.strip('/')
+        if not name:
+            code, body = 200, {'views': sorted(self.views)}
+        elif name not in self.views:
+            code, body = 404, {'error': 'no view %s' % (name,),
+                               'views': sorted(self.views)}
+        else:
+            try:
+                dpid = parse_qs(url.query).get('dpid', [None])[0]
+                dpid = None if dpid is None else int(dpid, 0)
+                code, body = 200, None          # the view's, below
+            except ValueError as e:
+                code, body = 400, {'error': 'bad dpid: %s' % (e,)}
+        try:
+            if body is None:
+                start = time.time()
+                body = {'view': name, 'time': start,
+                        'data': self.views[name](dpid)}
+                body['took_ms'] = (time.time() - start) * 1000
+            data = _dump(body)
+        except Exception as e:                  # a view's bug: still answer
+            code = 500
+            data = _dump({'error': '%s: %s' % (type(e).__name__, e),
+                          'view': name})
+        req.send_response(code)
+        req.send_header('Content-Type', 'application/json')
+        req.send_header('Content-Length', str(len(data)))
+        req.end_headers()
+        req.wfile.write(data)
+
+
+def _dump(body):
+    return json.dumps(body, default=str, sort_keys=True, indent=1).encode()
@@ -0,0 +1,93 @@
+# IPv6 neighbor discovery for Part4Controller
+#
+# the IPv6 counterpart of the ARP handling in part4controller: a cache
+# of learned IPv6 neighbors, and a proxy that answers neighbor
+# solicitations on the target's behalf so they never have to be flooded
+
+from collections import OrderedDict
+
+from pox.lib.addresses import IPAddr6
+import pox.lib.packet as pkt
+from pox.lib.packet.icmpv6 import (icmpv6, NDNeighborAdvertisement,
+                                   NDOptTargetLinkLayerAddress,
+                                   TYPE_NEIGHBOR_SOLICITATION,
+                                   TYPE_NEIGHBOR_ADVERTISEMENT)
+
+import clock
+
+# all-nodes multicast, where unsolicited/DAD answers go
+ALL_NODES = IPAddr6("ff02::1")
+
+
+class NeighborCache (object):
+    """
+    Maps IPv6 addresses to the (MAC, port) they were last seen on.
+    """
+
+    def __init__(self, lifetime=300, max_entries=4096):
+        self.lifetime = lifetime            # forget neighbors after this
+        self.max_entries = max_entries      # bound the cache size
+        # map: IPv6 to (mac, port, last seen)
+        self._entries = OrderedDict()
+
+    # learns mac/port for ip, returns True if it is new or has moved
+    def learn(self, ip, mac, port, now=None):
+        if ip == IPAddr6.UNDEFINED or ip.is_multicast:
+            return False                    # DAD probes, group addresses
+        now = clock.now() if now is None else now
+        old = self._entries.pop(ip, None)
+        self._entries[ip] = (mac, port, now)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return old is None or old[:2] != (mac, port)
+
+    # (mac, port) of ip, or None if unknown or stale
+    def lookup(self, ip, now=None):
+        e = self._entries.get(ip)
+        if e is None:
+            return None
+        now = clock.now() if now is None else now
+        if now - e[2] > self.lifetime:
+            del self._entries[ip]
+            return None
+        return e[:2]
+
+    def forget(self, ip):
+        self._entries.pop(ip, None)
+
+    def __contains__(self, ip):
+        return self.lookup(ip) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def items(self):
+        return [(ip, e[:2]) for ip, e in list(self._entries.items())]
+
+
+# is p (an ethernet frame) an ICMPv6 neighbor solicitation?
+def is_solicitation(p):
+    i = p.find('icmpv6')
+    return i is not None and i.type == TYPE_NEIGHBOR_SOLICITATION
+
+
+# builds the advertisement target_mac would send in answer to the
+# neighbor solicitation in ethernet frame p
+def proxy_advertisement(p, target_mac):
+    ip = p.next
+    ns = ip.next.next
+    na = NDNeighborAdvertisement()
+    na.target = ns.target
+    na.is_solicited = ip.srcip != IPAddr6.UNDEFINED
+    na.is_override = True
+    na.options.append(NDOptTargetLinkLayerAddress(address=target_mac))
+    i = icmpv6(type=TYPE_NEIGHBOR_ADVERTISEMENT)
+    i.set_payload(na)
+    r = pkt.ipv6(srcip=ns.target,
+                 dstip=ip.srcip if na.is_solicited else ALL_NODES,
+                 next_header_type=pkt.ipv6.ICMP6_PROTOCOL,
+                 hop_limit=255)
+    r.set_payload(i)
+    e = pkt.ethernet(type=pkt.ethernet.IPV6_TYPE, src=target_mac, dst=p.src)
+    e.set_payload(r)
+    return e
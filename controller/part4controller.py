@@ -5,20 +5,76 @@
 
 from pox.core import core
 import pox.openflow.libopenflow_01 as of
-from pox.lib.addresses import IPAddr, IPAddr6, EthAddr
+import pox.openflow.nicira as nx
+from pox.lib.addresses import IPAddr, EthAddr
 import pox.lib.packet as pkt
+from pox.lib.recoco import Timer
+from flowtimeout import AdaptiveTimeout
+from ndp import NeighborCache, is_solicitation, proxy_advertisement
+from conntrack import (ConnTrack, five_tuple, match_tuple,
+                       NEW, ESTABLISHED, DENIED)
+from rib import RoutingTable, Route
+from sketch import HeavyHitters
+from probe import LatencyProbes, ECHO, BARRIER, SWITCH, CONTROLLER
+from cluster import Cluster, SQLiteStore
+from topology import Topology
+from introspect import IntrospectionServer
+import policy
+import verify
+import copy
+import os
+import time
 
 log = core.getLogger()
 
-# statically allocate a routing table for hosts
-# MACs used in only in part 4
-IPS = {
-    "h10": ("10.0.1.10", '00:00:00:00:00:01'),
-    "h20": ("10.0.2.20", '00:00:00:00:00:02'),
-    "h30": ("10.0.3.30", '00:00:00:00:00:03'),
-    "serv1": ("10.0.4.10", '00:00:00:00:00:04'),
-    "hnotrust": ("172.16.10.100", '00:00:00:00:00:05'),
-}
+# how often (seconds) the PacketIn/flow counters are logged
+STATS_INTERVAL = 30
+
+# how often (seconds) the policy file is checked for changes
+POLICY_INTERVAL = 2
+
+# how often (seconds) each connection gets an echo and a barrier probe
+PROBE_INTERVAL = 5
+
+# how often (seconds) a cluster member heartbeats and checks mastership
+CLUSTER_INTERVAL = 1
+
+# route by prefix instead of learning hosts (see launch)
+ROUTED = False
+
+# split cores21 into an ACL table and a forwarding table (see launch)
+PIPELINE = False
+
+# PacketIns/s above which a host pair gets one coarse, long-lived rule
+# instead of a rule per connection (see launch); 0 never coarsens
+HEAVY_RATE = 0
+
+# this instance's Cluster, if running as one of several (see launch)
+CLUSTER = None
+
+# hosts that may only answer connections, never open them (see launch)
+REPLY_ONLY = ()
+
+# the switch graph, when rerouting around failed links (see launch)
+TOPOLOGY = None
+
+# ports of cores21 set up with queues for POLICY's qos (see launch)
+QUEUE_PORTS = ()
+
+# how long (seconds) a new switch floods nowhere, while LLDP finds its
+# links; set from discovery's send cycle (see launch)
+HOLD_DOWN = 6
+
+# statically allocate a routing table for hosts, and the per-subnet
+# routes of part4_topo (in policy.py, which verify.py shares)
+IPS = policy.IPS
+ROUTES = policy.ROUTES
+
+# the policy in force: hosts, block list and routes (see policy.py)
+POLICY = policy.default(IPS, ROUTES)
+
+# map: dpid to its Part4Controller, for reloads
+_controllers = {}
 
 
 class Part4Controller (object):
@@ -34,6 +90,35 @@ class Part4Controller (object):
 
         # This binds our PacketIn event listener
         connection.addListeners(self)
+        # PacketIn/flow counters, logged every STATS_INTERVAL seconds
+        self._stats = {'packet_in': 0, 'flows': 0, 'reinstalls': 0,
+                       'removed': 0, 'rerouted': 0}
+        self._last_stats = (time.time(), dict(self._stats))
+        self._rules = {}                            # static rules sent so far
+        self._barrier = None                        # (xid, sent at) of _apply
+        self._pipeline = PIPELINE and connection.dpid == 21
+        self._table_xid = None                      # xid of the table_id request
+        _controllers[connection.dpid] = self
+        # in a cluster, only the master of a switch may change it
+        if CLUSTER is not None:
+            CLUSTER.connected(connection.dpid)
+        self._master = CLUSTER is None or CLUSTER.is_master(connection.dpid)
+        if CLUSTER is not None:
+            self._send_role()
+        # control channel latency, probed every PROBE_INTERVAL seconds
+        self._probes = LatencyProbes()
+        self._echo = self._hook_echo()
+        if not self._echo:                          # barriers tell health
+            self._probes.health = BARRIER
+        self._probe_timer = Timer(PROBE_INTERVAL, self._probe, recurring=True)
+        self._stats_timer = Timer(STATS_INTERVAL, self._log_stats,
+                                  recurring=True)
+        # with a topology, flood only along its spanning tree
+        self._flood = {}                            # map: port to flooding?
+        self._held = TOPOLOGY is not None
+        if self._held:
+            self.update_flooding()
+            Timer(HOLD_DOWN, self._release)
         # use the dpid to figure out what switch is being created
         if (connection.dpid == 1):
             self.s1_setup()
@@ -50,41 +135,321 @@ class Part4Controller (object):
             exit(1)
 
     def s1_setup(self):
-        self._allow_all()
+        self._apply(self._compile())                # flood/drop (allow_all)
 
     def s2_setup(self):
-        self._allow_all()
+        self._apply(self._compile())
 
     def s3_setup(self):
-        self._allow_all()
+        self._apply(self._compile())
 
     # we only keep the blocking rules; all other traffic uses switch learning
     def cores21_setup(self):
-        self._block()                               # still block comm.s w/hnotrust
         self._table = {}                            # map: IPs to this dpid
+        self._neighbors = NeighborCache()           # map: IPv6s to this dpid
+        self._conntrack = ConnTrack(reply_only=[IPAddr(POLICY['hosts'][h][0])
+                                                for h in REPLY_ONLY])
+        self._rib = self._build_rib()
+        if self._pipeline:                          # flow_mods name a table
+            req = nx.nx_flow_mod_table_id()
+            self._table_xid = req.xid
+            self.connection.send(req)
+        self._apply(self._compile())                # still block comm.s w/hnotrust
+        self._timeouts = AdaptiveTimeout()          # per-pair idle timeouts
+        self._flows = {}                            # learned flows, see _install
+        self._moved = {}                            # map: port to hosts moved off
+        self._reroute = None                        # (xid, started, flows)
+        # map: (port, queue) to (tx_bytes, tx_packets, tx_errors, when)
+        self._queues = {}
+        # top (src, dst, dpid) talkers, for PacketIns and installed flows
+        self._hitters = {'packet_in': HeavyHitters(),
+                         'flows': HeavyHitters()}
 
     def dcs31_setup(self):
-        self._allow_all()
-
-    # flood all communications going to through the net, dropping the rest
-    def _allow_all(self, act=of.ofp_action_output(port=of.OFPP_FLOOD)):
-        self.connection.send(of.ofp_flow_mod(action=act,
-                                             priority=2))     # flood to all ports
-        # otherwise, iperfs will hang
-        self.connection.send(of.ofp_flow_mod(priority=1))
-
-    # block ICMP from hnotrust to anyone, and block all IP to serv1
-    def _block(self, src=IPS['hnotrust'][0], dst=IPS['serv1'][0]):
-        block_icmp = of.ofp_flow_mod(priority=20,
-                                     match=of.ofp_match(dl_type=0x800,
-                                                        nw_proto=pkt.ipv4.ICMP_PROTOCOL,
-                                                        nw_src=src))
-        self.connection.send(block_icmp)
-        block_to_serv = of.ofp_flow_mod(priority=19,
-                                        match=of.ofp_match(dl_type=0x800,
-                                                           nw_src=src,
-                                                           nw_dst=dst))
-        self.connection.send(block_to_serv)
+        self._apply(self._compile())
+
+    # the static rules this switch should have under POLICY
+    def _compile(self):
+        if self.connection.dpid == 21:
+            return policy.core(POLICY, ROUTED,
+                               str(self.dpid_to_mac(self.connection.dpid)),
+                               self._pipeline, QUEUE_PORTS)
+        return policy.allow_all()
+
+    def _build_rib(self):
+        hosts = POLICY['hosts']
+        return RoutingTable(Route(n, IPAddr(g), p, EthAddr(hosts[h][1]))
+                            for n, g, p, h in POLICY['routes'])
+
+    # POLICY changed: bring this switch's static rules up to date
+    def reload(self):
+        if hasattr(self, '_rib'):
+            self._rib = self._build_rib()
+            self._conntrack.reply_only = set(IPAddr(POLICY['hosts'][h][0])
+                                             for h in REPLY_ONLY)
+        self._apply(self._compile())
+
+    # send only what differs between the static rules the switch has and
+    # rules, then a barrier; learned flows are left alone
+    def _apply(self, rules):
+        if not self._master:                        # the master does this
+            return
+        add, modify, delete = policy.diff(self._rules, rules)
+        for cmd, changes in ((of.OFPFC_DELETE_STRICT, delete),
+                             (of.OFPFC_MODIFY_STRICT, modify),
+                             (of.OFPFC_ADD, add)):
+            for table, prio, match, acts in changes:
+                self.connection.send(self._flow_mod(table, command=cmd,
+                                                    priority=prio,
+                                                    match=of.ofp_match(**dict(match)),
+                                                    actions=self._actions(acts)))
+        barrier = of.ofp_barrier_request()
+        self._barrier = (barrier.xid, time.time())
+        self.connection.send(barrier)
+        self._rules = rules
+        log.debug("dpid %s: %d rules added, %d modified, %d deleted",
+                  self.connection.dpid, len(add), len(modify), len(delete))
+
+    # a flow_mod for table, if this switch runs the pipeline
+    def _flow_mod(self, table, **kw):
+        if self._pipeline:
+            return nx.ofp_flow_mod_table_id(table_id=table, **kw)
+        return of.ofp_flow_mod(**kw)
+
+    # the switch has everything _apply sent: log how long that took, and
+    # how many static rules each table holds
+    def _handle_BarrierIn(self, event):
+        self._probes.answered(event.xid)
+        if self._reroute is not None and event.xid == self._reroute[0]:
+            log.info("dpid %s: %d flows rerouted, in place %.1f ms after "
+                     "the failure", self.connection.dpid, self._reroute[2],
+                     (time.time() - self._reroute[1]) * 1000)
+            self._reroute = None
+        if self._barrier is None or event.xid != self._barrier[0]:
+            return
+        tables = {}
+        for key in self._rules:
+            tables[key[0]] = tables.get(key[0], 0) + 1
+        log.info("dpid %s: rules in place after %.1f ms, per table %s",
+                 self.connection.dpid, (time.time() - self._barrier[1]) * 1000,
+                 tables)
+        self._barrier = None
+
+    # no Nicira extensions here (the table_id request failed): fall back
+    # to a single table.  Other errors (a bad queue in an enqueue, ...)
+    # are not about tables
+    def _handle_ErrorIn(self, event):
+        if not self._pipeline or event.ofp.xid != self._table_xid or \
+                event.ofp.type != of.OFPET_BAD_REQUEST:
+            return
+        log.warning("dpid %s: no multi-table support (%s), using one table",
+                    self.connection.dpid, event.asString())
+        self._pipeline = False
+        self.connection.send(of.ofp_flow_mod(command=of.OFPFC_DELETE))
+        # the delete's FlowRemoveds are ignored (OFPRR_DELETE), so forget
+        # the learned flows and the connections they carried here
+        self._rules = {}
+        self._flows = {}
+        self._conntrack = ConnTrack(reply_only=self._conntrack.reply_only)
+        self._apply(self._compile())
+
+    # compiled (policy.py) actions as OpenFlow actions
+    def _actions(self, acts):
+        out = []
+        for a in acts:
+            if a[0] == 'output':
+                port = {policy.FLOOD: of.OFPP_FLOOD,
+                        policy.CONTROLLER: of.OFPP_CONTROLLER}.get(a[1], a[1])
+                out.append(of.ofp_action_output(port=port))
+            elif a[0] == 'enqueue':
+                out.append(of.ofp_action_enqueue(port=a[1], queue_id=a[2]))
+            elif a[0] == 'resubmit':
+                out.append(nx.nx_action_resubmit.resubmit_table(table=a[1]))
+            elif a[0] == 'set_src':
+                out.append(of.ofp_action_dl_addr.set_src(EthAddr(a[1])))
+            elif a[0] == 'set_dst':
+                out.append(of.ofp_action_dl_addr.set_dst(EthAddr(a[1])))
+            elif a[0] == 'dec_ttl':
+                out.append(nx.nx_action_dec_ttl())
+        return out
+
+    def _handle_ConnectionDown(self, event):
+        if _controllers.get(self.connection.dpid) is self:
+            del _controllers[self.connection.dpid]
+            if CLUSTER is not None:                 # others may master it
+                CLUSTER.disconnected(self.connection.dpid)
+            if TOPOLOGY is not None:                # don't wait for LLDP
+                _switch_down(self.connection.dpid)
+        self._probe_timer.cancel()
+        self._stats_timer.cancel()
+
+    def _send_role(self):
+        self.connection.send(nx.nx_role_request(master=self._master,
+                                                slave=not self._master))
+
+    # take this switch over from a member that died, with what it had
+    # learned, or hand it to a member that joined
+    def check_master(self):
+        master = CLUSTER.is_master(self.connection.dpid)
+        if master == self._master:
+            return
+        self._master = master
+        self._send_role()
+        if not master:
+            log.info("dpid %s: now mastered by %s", self.connection.dpid,
+                     CLUSTER.master(self.connection.dpid))
+            return
+        if hasattr(self, '_table'):
+            for ip, (mac, port) in CLUSTER.hosts(self.connection.dpid).items():
+                self._table.setdefault(IPAddr(ip), (EthAddr(mac), port))
+        self._rules = {}                            # don't know what it has
+        self._apply(self._compile())
+        log.info("dpid %s: took over as master", self.connection.dpid)
+
+    # POX answers echo replies itself without raising an event, so wrap
+    # this connection's handler for them; False if it can't be done
+    def _hook_echo(self):
+        handlers = getattr(self.connection, 'handlers', None)
+        if not isinstance(handlers, list) or \
+                len(handlers) <= of.OFPT_ECHO_REPLY:
+            log.debug("dpid %s: can't see echo replies, barriers only",
+                      self.connection.dpid)
+            return False
+        handlers = list(handlers)               # just for this connection
+        old = handlers[of.OFPT_ECHO_REPLY]
+
+        def echo_reply(*args):
+            self._probes.answered(args[-1].xid)
+            if old is not None:
+                old(*args)
+        handlers[of.OFPT_ECHO_REPLY] = echo_reply
+        self.connection.handlers = handlers
+        return True
+
+    # send this round's probes, and report a connection going bad or
+    # getting better
+    def _probe(self):
+        if self._probes.expire():
+            if self._probes.degraded:
+                log.warning("dpid %s: control channel degraded %s",
+                            self.connection.dpid,
+                            self._probes.summary()[self._probes.health])
+            else:
+                log.info("dpid %s: control channel recovered",
+                         self.connection.dpid)
+        if self._echo and not self._probes.waiting(ECHO):
+            req = of.ofp_echo_request()
+            self._probes.sent(req.xid, ECHO)
+            self.connection.send(req)
+        if not self._probes.waiting(BARRIER):
+            b = of.ofp_barrier_request()
+            self._probes.sent(b.xid, BARRIER)
+            self.connection.send(b)
+
+    # set which ports flood: while held, none; then host ports and the
+    # ports on TOPOLOGY's spanning tree, so redundant links make no loops
+    def update_flooding(self):
+        if not self._master:
+            return
+        for p in self.connection.ports.values():
+            if p.port_no >= of.OFPP_MAX:
+                continue
+            flood = not self._held and \
+                TOPOLOGY.floods(self.connection.dpid, p.port_no)
+            if self._flood.get(p.port_no) == flood:
+                continue
+            self._flood[p.port_no] = flood
+            self.connection.send(of.ofp_port_mod(
+                port_no=p.port_no, hw_addr=p.hw_addr, mask=of.OFPPC_NO_FLOOD,
+                config=0 if flood else of.OFPPC_NO_FLOOD))
+
+    def _release(self):
+        self._held = False
+        self.update_flooding()
+
+    # a port went down, or away
+    def _handle_PortStatus(self, event):
+        if TOPOLOGY is None:
+            return
+        desc = event.ofp.desc
+        if event.deleted or desc.state & of.OFPPS_LINK_DOWN or \
+                desc.config & of.OFPPC_PORT_DOWN:
+            _port_down(self.connection.dpid, event.port)
+        else:
+            self._flood.pop(event.port, None)       # new, or back: resend
+            self.update_flooding()
+
+    # the link on port failed: move the hosts learned behind it and the
+    # learned flows using it to backup (None: forget and delete them);
+    # hosts limits the move to the flows to/from those
+    def reroute(self, port, backup, hosts=None, start=None):
+        if not hasattr(self, '_flows') or not self._master:
+            return
+        start = time.time() if start is None else start
+        moved = set()
+        for ip, (mac, p) in list(self._table.items()):
+            if p != port or (hosts is not None and ip not in hosts):
+                continue
+            moved.update((ip, mac))
+            if backup is None:
+                del self._table[ip]
+            else:
+                self._table[ip] = (mac, backup)
+        for ip, (mac, p) in self._neighbors.items():
+            if p != port or (hosts is not None and mac not in hosts):
+                continue
+            moved.add(mac)
+            if backup is None:
+                self._neighbors.forget(ip)
+            else:
+                self._neighbors.learn(ip, mac, backup)
+        n = 0
+        outputs = (of.ofp_action_output, of.ofp_action_enqueue)
+        for key, (match, actions, idle, src, dst, prio) in \
+                list(self._flows.items()):
+            out = [a.port for a in actions if isinstance(a, outputs)]
+            to = port in out and (hosts is None or dst in hosts)
+            back = match.in_port == port and (hosts is None or src in hosts)
+            if not to and not back:
+                continue
+            self.connection.send(self._flow_mod(
+                policy.FORWARD_TABLE, command=of.OFPFC_DELETE_STRICT,
+                priority=prio, match=match))
+            del self._flows[key]
+            n += 1
+            if backup is None:
+                if match.dl_type == 0x800 and match.nw_proto is not None:
+                    self._conntrack.flow_removed(match_tuple(match))
+                continue
+            match = copy.copy(match)
+            if back:
+                match.in_port = backup
+            acts = []
+            for a in actions:
+                if isinstance(a, outputs) and to and a.port == port:
+                    a = self._out(backup, getattr(a, 'queue_id', None))
+                if isinstance(a, outputs) and a.port == match.in_port:
+                    a = of.ofp_action_output(port=of.OFPP_IN_PORT)
+                acts.append(a)
+            self._send_flow(match, acts, src, dst, idle, priority=prio)
+        if backup is not None and hosts is None:
+            self._moved[port] = (backup, moved)
+        if not moved and not n:
+            return
+        self._stats['rerouted'] += n
+        barrier = of.ofp_barrier_request()
+        self._reroute = (barrier.xid, start, n)
+        self.connection.send(barrier)
+        log.warning("dpid %s: %d hosts and %d flows moved from port %s to %s",
+                    self.connection.dpid, len(moved), n, port,
+                    'port %s' % (backup,) if backup is not None else 'nowhere')
+
+    # the link on port is back: move what reroute moved off it back on
+    def restore(self, port):
+        if not hasattr(self, '_moved') or port not in self._moved:
+            return
+        backup, hosts = self._moved.pop(port)
+        self.reroute(backup, port, hosts)
 
     # allow IP traffic as normal
     def _internal_to_external(self):
@@ -102,6 +467,13 @@ class Part4Controller (object):
                                                  match=of.ofp_match(dl_type=0x800,
                                                                     nw_dst=h)))
 
+    # output to port, through queue there if it has POLICY's queues
+    def _out(self, port, queue=None):
+        if queue is not None and port in QUEUE_PORTS and \
+                self.connection.dpid == 21:
+            return of.ofp_action_enqueue(port=port, queue_id=queue)
+        return of.ofp_action_output(port=port)
+
     # used in part 4 to handle individual ARP packets
     # not needed for part 3 (USE RULES!)
     # causes the switch to output packet_in on out_port
@@ -119,20 +491,45 @@ class Part4Controller (object):
         forwarded to this method to be handled by the controller
         """
 
+        start = time.time()
+        if not self._master:                                # not ours to handle
+            return
         packet = event.parsed  # This is the parsed packet data.
         if not packet.parsed:
             log.warning("Ignoring incomplete packet")
             return
+        flows = self._stats['flows']
 
         packet_in = event.ofp  # The actual ofp_packet_in message.
+        self._stats['packet_in'] += 1
+        talkers = self._talkers(packet)
+        if talkers is not None:
+            self._hitters['packet_in'].add(talkers + (self.connection.dpid,))
 
         if self._is_arp(packet):                            # handle ARP traffic?
             self._handle_ARP(packet, event)
-        else:                                               # learn and forward?
+        elif packet.type == packet.IPV6_TYPE:               # IPv6 and NDP?
+            self._handle_IPv6(packet, event)
+        elif packet.type == packet.IP_TYPE and ROUTED:      # route it?
+            self._route(packet, event)
+        elif packet.type == packet.IP_TYPE:                 # learn and forward?
             self._forward_to_switch(packet, event)
 
-        print('Unhandled packet from ' +
-              str(self.connection.dpid)+':'+packet.dump())
+        if self._stats['flows'] != flows:                   # time flow setup
+            self._probes.add(CONTROLLER, time.time() - start)
+            if not self._probes.waiting(SWITCH):
+                b = of.ofp_barrier_request()
+                self._probes.sent(b.xid, SWITCH)
+                self.connection.send(b)
+
+    # (src, dst) addresses of an ARP, IPv4 or IPv6 packet, else None
+    def _talkers(self, p):
+        n = p.next
+        if self._is_arp(p):
+            return (n.protosrc, n.protodst)
+        if p.type in (p.IP_TYPE, p.IPV6_TYPE):
+            return (n.srcip, n.dstip)
+        return None
 
     # learns port/MAC info, if new, otherwise, updates known
     def _update(self, inport, packet, arp=False):
@@ -145,8 +542,11 @@ class Part4Controller (object):
         elif src not in self._table:
             # new dst to learn
             log.debug("Learned %s" % str(src))
+        else:
+            return                                          # nothing new
         self._table[src] = (packet.src, inport)
-        log.debug(self._table)
+        if CLUSTER is not None:                             # for a successor
+            CLUSTER.share_host(self.connection.dpid, src, packet.src, inport)
 
     def _is_arp(self, p):
         return p.type == p.ARP_TYPE
@@ -172,6 +572,8 @@ class Part4Controller (object):
         r.protodst = a.protosrc
         r.protosrc = a.protodst
         r.hwsrc = p.src
+        if self._rib.gateway(a.protodst) is not None:     # asking for us?
+            r.hwsrc = self.dpid_to_mac(me)
         e = pkt.ethernet(type=p.type, src=self.dpid_to_mac(me), dst=a.hwsrc)
         e.set_payload(r)
         msg = of.ofp_packet_out()
@@ -184,51 +586,532 @@ class Part4Controller (object):
     def dpid_to_mac(self, dpid):
         return EthAddr("%012x" % (dpid & 0xffFFffFFffFF,))
 
+    # send an IPv4 packet along its longest prefix match
+    def _route(self, p, event):
+        r = self._rib.lookup(p.next.dstip)
+        if r is None:
+            log.warning("No route to " + str(p.next.dstip))
+            return
+        msg = of.ofp_packet_out(data=event.ofp)
+        msg.actions = self._actions(policy.route_actions(
+            r.port, str(r.mac), str(self.dpid_to_mac(self.connection.dpid))))
+        event.connection.send(msg)
+
+    # learn IPv6 neighbors, proxy NDP, and forward like IPv4 otherwise
+    def _handle_IPv6(self, p, event):
+        ip = p.next
+        if self._neighbors.learn(ip.srcip, p.src, event.port):
+            log.debug("Learned %s" % str(ip.srcip))
+
+        if is_solicitation(p):                              # who has target?
+            target = ip.next.next.target
+            known = self._neighbors.lookup(target)
+            if known is None:                               # ask everyone
+                self.resend_packet(event.ofp, of.OFPP_FLOOD)
+            elif known[1] != event.port:                    # answer for it
+                msg = of.ofp_packet_out()
+                msg.data = proxy_advertisement(p, known[0]).pack()
+                msg.actions.append(of.ofp_action_output(port=of.OFPP_IN_PORT))
+                msg.in_port = event.port
+                event.connection.send(msg)
+                log.debug("Proxied NDP for " + str(target))
+            return
+
+        known = self._neighbors.lookup(ip.dstip)
+        if known is None:                                   # multicast/unknown
+            self.resend_packet(event.ofp, of.OFPP_FLOOD)
+            return
+        mac, port = known
+        if port == event.port:
+            log.warning(
+                "Not sending packet back out of in-port " + str(event.port))
+            return
+        # OpenFlow 1.0 can't match IPv6 headers, so key the flow on L2
+        self._install(of.ofp_match.from_packet(p, event.port),
+                      [of.ofp_action_dl_addr.set_dst(mac),
+                       of.ofp_action_output(port=port)],
+                      p.src, mac, buffer_id=event.ofp.buffer_id)
+        log.info('Added flow rule: traffic to ' +
+                 str(ip.dstip) + ' via ' + str(port))
+
+    # send a learned flow, with an idle timeout picked for src -> dst
+    def _install(self, match, actions, src, dst, buffer_id=None, idle=None,
+                 priority=of.OFP_DEFAULT_PRIORITY):
+        if self._timeouts.returning(src, dst):
+            self._stats['reinstalls'] += 1                  # expired too early
+        if idle is None:
+            idle = self._timeouts.timeout(src, dst)
+        self._hitters['flows'].add((src, dst, self.connection.dpid))
+        self._send_flow(match, actions, src, dst, idle, buffer_id, priority)
+        self._stats['flows'] += 1
+
+    # send a learned flow, and remember it until it is removed
+    def _send_flow(self, match, actions, src, dst, idle, buffer_id=None,
+                   priority=of.OFP_DEFAULT_PRIORITY):
+        self.connection.send(self._flow_mod(policy.FORWARD_TABLE,
+                                            command=of.OFPFC_ADD,
+                                            priority=priority,
+                                            idle_timeout=idle,
+                                            hard_timeout=of.OFP_FLOW_PERMANENT,
+                                            flags=of.OFPFF_SEND_FLOW_REM,
+                                            buffer_id=buffer_id,
+                                            actions=actions,
+                                            match=match))
+        self._flows[_flow_key(match)] = (match, actions, idle, src, dst,
+                                         priority)
+
     # forward this packet to its destaination, and add to the flow table
     def _forward_to_switch(self, p, event):
-        log.debug('HEEEEEE: ' + str(p.next.dstip))
-        if not isinstance(p.next.dstip, IPAddr6):
-            # new knowledge?
-            self._update(event.port, p)
+        self._update(event.port, p)                         # new knowledge?
         conn = event.connection
         me = conn.dpid
 
         if p.next.dstip in self._table:                       # forward to dst?
             dest = p.next.dstip
-            if isinstance(dest, IPAddr6):
-                dest = self._find_by_port(event.port)
             dst = (self._table[dest][-1], self._table[dest][0])  # port, mac
 
             if dst[0] == event.port:                            # through in-port?
                 log.warning(
                     "Not sending packet back out of in-port " + str(event.port))
             else:
-                do = [of.ofp_action_dl_addr.set_dst(dst[1]),      # MAC addr of dest
-                      of.ofp_action_output(port=dst[0])]          # the port to dest
+                key = five_tuple(p.next)
+                c, is_reply = self._conntrack.track(key)
+                if c.state == DENIED:                           # may not open it
+                    self._install(of.ofp_match.from_packet(p, event.port), [],
+                                  p.next.srcip, dest,
+                                  buffer_id=event.ofp.buffer_id)
+                    self._conntrack.flow_added(key)
+                    log.info('Denied connection ' + str(key))
+                    return
                 want = of.ofp_match.from_packet(p, event.port)
-                conn.send(of.ofp_flow_mod(command=of.OFPFC_ADD,   # learn new rule
-                                          idle_timeout=10,        # from l3learning.py
-                                          hard_timeout=of.OFP_FLOW_PERMANENT,
-                                          buffer_id=event.ofp.buffer_id,
-                                          actions=do,
-                                          match=want))
+                queue = policy.queue(POLICY, key[0], key[1], key[2],
+                                     key[4] or None)
+                idle, prio = None, of.OFP_DEFAULT_PRIORITY
+                # (not to reply-only hosts: their answers to later
+                # connections of the pair would find no reply flow, as
+                # those skip the controller, and be denied)
+                if HEAVY_RATE and self._conntrack.allowed(key) and \
+                        dest not in self._conntrack.reply_only and \
+                        self._hitters['packet_in'].heavy((p.next.srcip, dest, me),
+                                                         HEAVY_RATE) and \
+                        not policy.splits_pair(POLICY, p.next.srcip, dest):
+                    # busy pair: one rule for all of its traffic
+                    want = of.ofp_match(dl_type=0x800, nw_src=p.next.srcip,
+                                        nw_dst=dest)
+                    queue = policy.queue(POLICY, None, p.next.srcip, dest, None)
+                    idle = self._timeouts.high
+                    # under the block list in its table, which still
+                    # drops the traffic of the pair it forbids
+                    prio = policy.COARSE_PRIORITY
+                do = [of.ofp_action_dl_addr.set_dst(dst[1]),      # MAC addr of dest
+                      self._out(dst[0], queue)]                   # the port to dest
+                self._install(want, do, p.next.srcip, dest,       # learn new rule
+                              buffer_id=event.ofp.buffer_id, idle=idle,
+                              priority=prio)
+                if want.nw_proto is not None:                   # per connection
+                    self._conntrack.flow_added(key)
+                if c.state == NEW:                              # offload replies
+                    self._install_reply(p, event.port, key)
+                    c.state = ESTABLISHED
                 log.info('Added flow rule: traffic to ' +
                          str(dest) + ' via ' + str(dst[0]))
 
-            print('{a} forwarded packet from {b}>'.format(a=me, b=p.next.srcip) +
-                  '{a}, using port {b}'.format(a=p.next.dstip, b=dst[0]))
+    # install the reverse direction of the connection key, which packet p
+    # (received on inport) just opened, so replies skip the controller
+    def _install_reply(self, p, inport, key):
+        proto, src, dst, sport, dport = key
+        back = of.ofp_match(dl_type=0x800, nw_proto=proto,
+                            nw_src=dst, nw_dst=src,
+                            in_port=self._table[dst][-1])
+        if proto != pkt.ipv4.ICMP_PROTOCOL and (sport or dport):
+            back.tp_src = dport
+            back.tp_dst = sport
+        queue = policy.queue(POLICY, proto, dst, src, sport or None)
+        self._install(back, [of.ofp_action_dl_addr.set_dst(p.src),
+                             self._out(inport, queue)], dst, src)
+        self._conntrack.flow_added(key)
+
+    # a learned flow expired; tell the timeout policy how it behaved
+    def _handle_FlowRemoved(self, event):
+        if event.ofp.reason == of.OFPRR_DELETE:       # rerouted, see reroute
+            return
+        m = event.ofp.match
+        self._flows.pop(_flow_key(m), None)
+        if m.dl_type == pkt.ethernet.IPV6_TYPE:             # keyed on L2
+            src, dst = m.dl_src, m.dl_dst
+        else:
+            src, dst = m.nw_src, m.nw_dst
+            if m.nw_proto is not None:                      # one side done
+                self._conntrack.flow_removed(match_tuple(m))
+        if src is None or dst is None:
+            return
+        self._stats['removed'] += 1
+        self._timeouts.removed(src, dst, event.ofp.idle_timeout,
+                               event.ofp.packet_count)
+
+    # log PacketIn and flow install rates since the last call
+    def _log_stats(self):
+        now = time.time()
+        lat = self._probes.summary()
+        log.info("dpid %s: echo p50 %.2f ms p99 %.2f ms, barrier p50 %.2f ms, "
+                 "flow setup controller p50 %.2f ms + switch p50 %.2f ms, "
+                 "%d probes lost%s", self.connection.dpid,
+                 lat[ECHO]['p50_ms'], lat[ECHO]['p99_ms'],
+                 lat[BARRIER]['p50_ms'], lat[CONTROLLER]['p50_ms'],
+                 lat[SWITCH]['p50_ms'], lat['lost'],
+                 ', DEGRADED' if lat['degraded'] else '')
+        if not hasattr(self, '_table'):             # only cores21 learns
+            return
+        then, old = self._last_stats
+        span = max(now - then, 1e-6)
+        rate = dict((k, (self._stats[k] - old[k]) / span) for k in self._stats)
+        log.info("dpid %s: %.2f packet_in/s, %.2f flows/s, "
+                 "%.2f reinstalls/s, %d pairs tracked, %d IPv6 neighbors, "
+                 "%d connections %s",
+                 self.connection.dpid, rate['packet_in'], rate['flows'],
+                 rate['reinstalls'], len(self._timeouts),
+                 len(self._neighbors), len(self._conntrack),
+                 self._conntrack.states())
+        for name, hitters in sorted(self._hitters.items()):
+            top = ', '.join('%s>%s@%s %.2f/s' % (k[0], k[1], k[2], r)
+                            for k, c, r in hitters.top(now)[:5])
+            log.info("dpid %s: top %s talkers: %s", self.connection.dpid,
+                     name, top or 'none')
+        self._last_stats = (now, dict(self._stats))
+        for port in QUEUE_PORTS:                    # see _handle_QueueStats...
+            self.connection.send(of.ofp_stats_request(
+                body=of.ofp_queue_stats_request(port_no=port,
+                                                queue_id=of.OFPQ_ALL)))
+
+    # log what each queue sent since the last time, and what it dropped
+    def _handle_QueueStatsReceived(self, event):
+        now = time.time()
+        for q in event.stats:
+            key = (q.port_no, q.queue_id)
+            old = self._queues.get(key)
+            self._queues[key] = (q.tx_bytes, q.tx_packets, q.tx_errors, now)
+            if old is None:
+                continue
+            span = max(now - old[3], 1e-6)
+            log.info("dpid %s: port %s queue %s: %.1f kbit/s, %.1f packets/s, "
+                     "%d dropped", self.connection.dpid, q.port_no, q.queue_id,
+                     (q.tx_bytes - old[0]) * 8 / span / 1000,
+                     (q.tx_packets - old[1]) / span, q.tx_errors - old[2])
+
+    # what introspect.py shows of this switch: called from its thread, so
+    # every table is copied in one step and formatted from the copy
+    def view_hosts(self):
+        if not hasattr(self, '_table'):
+            return {}
+        return {'ipv4': dict((str(ip), (str(mac), port)) for ip, (mac, port)
+                             in list(self._table.items())),
+                'ipv6': dict((str(ip), (str(mac), port)) for ip, (mac, port)
+                             in self._neighbors.items())}
+
+    def view_flows(self):
+        static = [{'table': t, 'priority': p, 'match': dict(m),
+                   'actions': a} for (t, p, m), a in list(self._rules.items())]
+        learned = []
+        if hasattr(self, '_flows'):
+            for match, actions, idle, src, dst, prio in \
+                    list(self._flows.values()):
+                learned.append({'match': dict((f, v) for f, v in
+                                              zip(FLOW_FIELDS, _flow_key(match))
+                                              if v != 'None'),
+                                'actions': [str(a) for a in actions],
+                                'priority': prio, 'idle_timeout': idle})
+        return {'static': sorted(static, key=str), 'learned': learned}
+
+    def view_queues(self):
+        return {'switch': dict(('%s/%s' % k, {'tx_bytes': v[0],
+                                              'tx_packets': v[1],
+                                              'tx_errors': v[2],
+                                              'at': v[3]})
+                               for k, v in
+                               list(getattr(self, '_queues', {}).items())),
+                'probes_outstanding': self._probes.summary()['outstanding'],
+                'flows_learned': len(getattr(self, '_flows', ()))}
+
+    def view_counters(self):
+        out = {'stats': dict(self._stats), 'master': self._master,
+               'pipeline': self._pipeline, 'static_rules': len(self._rules)}
+        if hasattr(self, '_table'):
+            out.update(pairs_tracked=len(self._timeouts),
+                       ipv6_neighbors=len(self._neighbors),
+                       connections=len(self._conntrack),
+                       connection_states=self._conntrack.states(),
+                       top=dict((name, [(str(k), c, r) for k, c, r in h.last()])
+                                for name, h in self._hitters.items()))
+        return out
+
+    def view_latency(self):
+        return self._probes.summary()
+
+
+# an introspect.py view of every switch (or just dpid), from the
+# Part4Controller method view_<name>
+def _view(name):
+    def view(dpid):
+        out = {}
+        for d, c in sorted(list(_controllers.items())):
+            if dpid is None or d == dpid:
+                out[d] = getattr(c, 'view_' + name)()
+        return out
+    return view
+
+
+def _view_topology(dpid):
+    if TOPOLOGY is None:
+        return None
+    return {'root': TOPOLOGY.root, 'version': TOPOLOGY.version,
+            'links': TOPOLOGY.links()}
+
+
+def _view_policy(dpid):
+    return {'policy': POLICY, 'routed': ROUTED, 'pipeline': PIPELINE,
+            'reply_only': REPLY_ONLY, 'queue_ports': QUEUE_PORTS}
+
+
+# the match fields that tell two learned flows apart
+FLOW_FIELDS = ('in_port', 'dl_src', 'dl_dst', 'dl_type', 'nw_proto',
+               'nw_src', 'nw_dst', 'tp_src', 'tp_dst')
+
+
+# what tells two learned flows apart, and a FlowRemoved's flow
+def _flow_key(m):
+    return tuple(str(getattr(m, f)) for f in FLOW_FIELDS)
+
+
+# a link (dpid, port) was on failed: reroute along the backup path the
+# topology had for it, then flood along the new spanning tree
+def _port_down(dpid, port):
+    start = time.time()
+    ends = [(dpid, port)]
+    peer = TOPOLOGY.peer(dpid, port)
+    if peer is not None:
+        ends.append(peer)
+    backups = dict((p, TOPOLOGY.backup(p)) for d, p in ends
+                   if d == TOPOLOGY.root)
+    TOPOLOGY.link_down(dpid, port)
+    root = _controllers.get(TOPOLOGY.root)
+    if root is not None:
+        for p, backup in backups.items():
+            root.reroute(p, backup, start=start)
+    _topology_changed()
+
+
+# the switch dpid went away, and its links with it; those to the root
+# go last, so that the root's backups no longer lead through it
+def _switch_down(dpid):
+    ports = sorted(TOPOLOGY.switch_ports(dpid),
+                   key=lambda p: TOPOLOGY.peer(dpid, p)[0] == TOPOLOGY.root)
+    for port in ports:
+        if TOPOLOGY.peer(dpid, port) is not None:
+            _port_down(dpid, port)
 
-        def _find_by_port(prt):
-            for key in self._table:
-                if self._table[key][-1] == prt:
-                    return key
-            return None
 
+# LLDP found a link, or lost one
+def _handle_LinkEvent(event):
+    l = event.link
+    if event.removed:
+        if TOPOLOGY.peer(l.dpid1, l.port1) is not None:
+            _port_down(l.dpid1, l.port1)
+        return
+    if not TOPOLOGY.link_up(l.dpid1, l.port1, l.dpid2, l.port2):
+        return
+    root = _controllers.get(TOPOLOGY.root)
+    if root is not None:
+        for d, p in ((l.dpid1, l.port1), (l.dpid2, l.port2)):
+            if d == TOPOLOGY.root:
+                root.restore(p)
+    _topology_changed()
 
-def launch():
+
+def _topology_changed():
+    for c in list(_controllers.values()):
+        c.update_flooding()
+    log.debug("Topology: %d links, %s", len(TOPOLOGY), TOPOLOGY.links())
+
+
+# modification time of the policy file when it was last read
+_policy_mtime = None
+
+
+# reload POLICY from path if the file changed since it was last read
+def _check_policy(path):
+    global _policy_mtime, _policy_version
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError as e:
+        log.error("Can't read policy: %s", e)
+        return
+    if mtime == _policy_mtime:
+        return
+    _policy_mtime = mtime
+    # whatever is wrong with the file, log it and keep watching: an
+    # exception here would end the recurring Timer
+    try:
+        new = policy.load(path, policy.default(IPS, ROUTES))
+        if new == POLICY:
+            return
+        # don't put in force a policy that lets hnotrust reach serv1, or
+        # cuts internal hosts off one another
+        problems = verify.verify_part4(new, ROUTED, PIPELINE, REPLY_ONLY,
+                                       QUEUE_PORTS)
+        if problems:
+            for line in problems:
+                log.error("Policy %s: %s", path, line)
+            log.error("Not reloading policy %s: %d violations", path,
+                      len(problems))
+            return
+        _set_policy(new, path)
+        if CLUSTER is not None:
+            _policy_version = CLUSTER.share_policy(POLICY)
+    except (IOError, ValueError) as e:
+        log.error("Not reloading policy %s: %s", path, e)
+    except Exception:
+        log.exception("Not reloading policy %s", path)
+
+
+# put policy p (read from source) in force on every switch; raises
+# ValueError, with POLICY left as it was, if the switches can't use it
+def _set_policy(p, source):
+    global POLICY
+    policy.check(p)
+    for h in REPLY_ONLY:                    # see Part4Controller.reload
+        if h not in p['hosts']:
+            raise ValueError("no reply-only host %s" % (h,))
+    POLICY = p
+    start = time.time()
+    for c in list(_controllers.values()):
+        c.reload()
+    log.info("Reloaded policy %s in %.1f ms", source,
+             (time.time() - start) * 1000)
+
+
+# version of the cluster-wide policy in force here
+_policy_version = 0
+
+
+# heartbeat, pick up a policy another member loaded, and move switches
+# between members as they come and go
+def _cluster_tick():
+    global _policy_version
+    if CLUSTER.tick():
+        log.info("Cluster members: %s", ', '.join(CLUSTER.members()))
+    version, shared = CLUSTER.policy()
+    if version > _policy_version and shared is not None:
+        _policy_version = version
+        # log what is wrong with it and carry on: an exception here would
+        # end the recurring Timer, and with it this member's heartbeats
+        if shared != POLICY:
+            try:
+                _set_policy(shared, "from the cluster")
+            except ValueError as e:
+                log.error("Not reloading policy from the cluster: %s", e)
+            except Exception:
+                log.exception("Not reloading policy from the cluster")
+    for c in list(_controllers.values()):
+        c.check_master()
+
+
+def launch(reply_only="", routed=False, policy_file=None, heavy_rate=0,
+           pipeline=False, cluster=None, cluster_store=None, failover=False,
+           qos="", introspect=None):
     """
     Starts the component
+
+    reply_only is a comma separated list of IPS names that may answer
+    connections but not open them, e.g. --reply_only=serv1
+
+    --routed installs one rule per prefix in ROUTES on cores21 instead
+    of learning flows per host (needs Open vSwitch for TTL decrement)
+
+    policy_file is a JSON file overriding the hosts, block list and/or
+    routes of POLICY; it is watched, and every switch gets just the
+    rules that changed when it is edited, once verify.py finds that
+    they keep hnotrust away from serv1 and the other hosts connected
+
+    heavy_rate (PacketIns/s) gives host pairs above it one coarse,
+    long-lived rule instead of one rule per connection
+
+    --pipeline puts cores21's block list in table 0 and its forwarding
+    in table 1 (Nicira extensions, falls back to one table without them)
+
+    cluster names this instance as one of several connected to every
+    switch (e.g. --cluster=c1); learned hosts and the policy are shared
+    through cluster_store, a SQLite file all of them open (required),
+    and each switch is mastered by one live member connected to it.
+    Mastership is per switch, and only cores21 sends PacketIns, so
+    the member mastering it handles all of them: more members add
+    standbys, not capacity
+
+    --failover tracks the links between switches (run openflow.discovery
+    too), floods only along a spanning tree rooted at cores21, and when a
+    link of cores21 fails moves the flows using it to a precomputed
+    backup path, if the topology has one (e.g. topo/part4_failover.py)
+
+    qos is a comma separated list of cores21's ports that have queues
+    (e.g. --qos=4, as topo/part4_qos.py sets up); flows out of them go
+    to the queue POLICY's qos entries pick for them
+
+    introspect is a local port (e.g. --introspect=8081) to serve read
+    only JSON snapshots of the controller on: GET /hosts, /flows,
+    /queues, /counters, /latency, /topology or /policy, ?dpid=N for one
+    switch
     """
+    global REPLY_ONLY, ROUTED, HEAVY_RATE, PIPELINE, CLUSTER, TOPOLOGY
+    global QUEUE_PORTS
+    PIPELINE = bool(pipeline)
+    REPLY_ONLY = tuple(h for h in reply_only.split(',') if h)
+    ROUTED = bool(routed)
+    HEAVY_RATE = float(heavy_rate)
+    QUEUE_PORTS = tuple(int(p) for p in str(qos).split(',') if p)
+    # the cluster first, so a policy file read below is shared and not
+    # replaced by an older one from the store on the first tick
+    if cluster:
+        # an in-memory store would be this process's alone: each member
+        # would see only itself, and master every switch
+        if not cluster_store:
+            raise RuntimeError("--cluster needs a --cluster_store file "
+                               "shared by all the members")
+        CLUSTER = Cluster(SQLiteStore(cluster_store), cluster)
+        CLUSTER.tick()                          # see who is already up
+        Timer(CLUSTER_INTERVAL, _cluster_tick, recurring=True)
+        core.addListenerByName("GoingDownEvent", lambda e: CLUSTER.leave())
+
+    if policy_file:
+        _check_policy(policy_file)
+        Timer(POLICY_INTERVAL, _check_policy, args=[policy_file],
+              recurring=True)
+    for h in REPLY_ONLY:
+        if h not in POLICY['hosts']:
+            raise RuntimeError("Unknown host " + h)
+    if ROUTED and REPLY_ONLY:
+        raise RuntimeError("--reply_only needs per-connection flows, "
+                           "it can't be used with --routed")
+    if ROUTED and failover:
+        raise RuntimeError("--failover moves learned flows, "
+                           "it can't be used with --routed")
+
+    if failover:
+        TOPOLOGY = Topology(root=21)
+
+        def start_discovery():
+            global HOLD_DOWN
+            d = core.openflow_discovery
+            HOLD_DOWN = getattr(d, 'send_cycle_time', HOLD_DOWN - 1) + 1
+            d.addListenerByName("LinkEvent", _handle_LinkEvent)
+        core.call_when_ready(start_discovery, ['openflow_discovery'])
+
+    if introspect:
+        views = dict((n, _view(n)) for n in
+                     ('hosts', 'flows', 'queues', 'counters', 'latency'))
+        views.update(topology=_view_topology, policy=_view_policy)
+        server = IntrospectionServer(views, port=int(introspect)).start()
+        core.addListenerByName("GoingDownEvent", lambda e: server.stop())
+        log.info("Introspection on http://%s:%d/", *server.address)
+
     def start_switch(event):
         log.debug("Controlling %s" % (event.connection,))
         Part4Controller(event.connection)
@@ -0,0 +1,60 @@
+# Table occupancy of cores21 with and without the ACL/forwarding split
+#
+# compiles synthetic policies (one /24 and host per subnet, a block list
+# with some "allow" exceptions) in both modes, and counts the rules and
+# the time it takes; bring-up time on a real switch is logged by
+# part4controller ("rules in place after ...") when run in Mininet
+#
+#   python3 pipeline_bench.py
+
+import time
+
+import policy
+
+ROUTER = '00:00:00:00:00:15'
+
+
+def synthetic(subnets, blocks, allows):
+    hosts, routes, block = {}, [], []
+    for i in range(subnets):
+        name = 'h%d' % i
+        hosts[name] = ('10.%d.%d.10' % (i // 256, i % 256),
+                       '00:00:00:00:%02x:%02x' % (i // 256, i % 256))
+        routes.append(('10.%d.%d.0/24' % (i // 256, i % 256),
+                       '10.%d.%d.1' % (i // 256, i % 256), i + 1, name))
+    for i in range(blocks):
+        block.append({'src': 'h%d' % (i % subnets), 'proto': 'tcp',
+                      'port': 1000 + i})
+    for i in range(allows):                 # e.g. "h0 may always do ssh"
+        block.append({'src': 'h%d' % (i % subnets), 'proto': 'tcp',
+                      'port': 22, 'allow': True})
+    return {'hosts': hosts, 'block': block, 'routes': routes}
+
+
+def occupancy(p, pipeline, rounds=20):
+    start = time.time()
+    for _ in range(rounds):
+        rules = policy.core(p, routed=True, router_mac=ROUTER,
+                            pipeline=pipeline)
+    took = (time.time() - start) / rounds
+    tables = {}
+    for key in rules:
+        tables[key[0]] = tables.get(key[0], 0) + 1
+    return tables, took
+
+
+def main():
+    print("%8s %7s %7s | %14s | %22s" % ('subnets', 'blocks', 'allows',
+                                          'single table', 'pipeline t0 + t1'))
+    for subnets, blocks, allows in ((5, 2, 1), (50, 20, 5), (500, 100, 20),
+                                    (2000, 200, 50)):
+        p = synthetic(subnets, blocks, allows)
+        one, t1 = occupancy(p, False)
+        two, t2 = occupancy(p, True)
+        print("%8d %7d %7d | %6d %5.1fms | %6d + %6d %5.1fms" % (
+            subnets, blocks, allows, one[0], t1 * 1000,
+            two[0], two[1], t2 * 1000))
+
+
+if __name__ == '__main__':
+    main()
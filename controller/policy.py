@@ -0,0 +1,342 @@
+# Static policy for Part4Controller, and its compiler
+#
+# a policy is a dict with the hosts (name -> (ip, mac)), the block list
+# and the routes; it compiles to a rule set per switch: a dict from
+# (table, priority, match) to actions, all plain tuples, so that two
+# rule sets can be compared and only the difference sent to the switch
+#
+# qos entries put traffic into the queues that output ports were set
+# up with (queue 0 is what isn't classified); the switch only enqueues
+# on the ports it is told have queues
+#
+# with pipeline=True the core switch gets two tables, ACLs in table 0
+# and forwarding in table 1; otherwise everything shares table 0, and
+# an ACL entry that permits traffic has to be repeated for every route
+# it may take
+
+import ipaddress
+import json
+
+# tables of the pipeline
+ACL_TABLE = 0
+FORWARD_TABLE = 1
+
+# priorities of the compiled rules
+ALLOW_PRIORITY = 200        # exceptions to the block list (+ prefix length)
+BLOCK_PRIORITY = 100        # drops from the block list
+COARSE_PRIORITY = 90        # learned rules for a whole busy host pair
+QOS_PRIORITY = 50           # routes of classified traffic
+ROUTE_PRIORITY = 5          # per-prefix routes (+ prefix length)
+FLOOD_PRIORITY = 2          # flood everything on the edge switches
+DROP_PRIORITY = 1           # otherwise, iperfs will hang
+MISS_PRIORITY = 0           # what no other rule in a table matched
+
+PROTOCOLS = {'icmp': 1, 'tcp': 6, 'udp': 17}
+
+FLOOD = 'flood'             # stands in for OFPP_FLOOD in output actions
+CONTROLLER = 'controller'   # ... and this for OFPP_CONTROLLER
+
+
+# part4_topo's hosts, statically allocated: name -> (ip, mac)
+IPS = {
+    'h10': ('10.0.1.10', '00:00:00:00:00:01'),
+    'h20': ('10.0.2.20', '00:00:00:00:00:02'),
+    'h30': ('10.0.3.30', '00:00:00:00:00:03'),
+    'serv1': ('10.0.4.10', '00:00:00:00:00:04'),
+    'hnotrust': ('172.16.10.100', '00:00:00:00:00:05'),
+}
+
+# per-subnet routes of part4_topo on cores21: prefix, gateway the hosts
+# in it use, port towards it, and the host that is its next hop
+ROUTES = [
+    ('10.0.1.0/24', '10.0.1.1', 1, 'h10'),
+    ('10.0.2.0/24', '10.0.2.1', 2, 'h20'),
+    ('10.0.3.0/24', '10.0.3.1', 3, 'h30'),
+    ('10.0.4.0/24', '10.0.4.1', 4, 'serv1'),
+    ('172.16.10.0/24', '172.16.10.1', 5, 'hnotrust'),
+]
+
+
+# the policy the controller starts with, from its IPS and ROUTES
+def default(hosts, routes):
+    return {
+        'hosts': dict(hosts),
+        # block ICMP from hnotrust to anyone, and block all IP to serv1
+        'block': [{'src': 'hnotrust', 'proto': 'icmp'},
+                  {'src': 'hnotrust', 'dst': 'serv1'}],
+        'routes': [list(r) for r in routes],
+        # to serv1, pings and web requests go ahead of bulk transfers
+        'qos': [{'dst': 'serv1', 'proto': 'icmp', 'queue': 1},
+                {'dst': 'serv1', 'proto': 'tcp', 'port': 80, 'queue': 1},
+                {'dst': 'serv1', 'queue': 2}],
+    }
+
+
+# reads a policy file (JSON), filling what it leaves out from base
+def load(path, base):
+    with open(path) as f:
+        p = json.load(f)
+    if not isinstance(p, dict):
+        raise ValueError("policy must be an object")
+    policy = dict(base)
+    policy.update(p)
+    check(policy)
+    return policy
+
+
+# raises ValueError unless every part of the policy has the right shape
+# and refers only to hosts it defines
+def check(policy):
+    if not isinstance(policy, dict):
+        raise ValueError("policy must be an object")
+    hosts = policy.get('hosts')
+    if not isinstance(hosts, dict):
+        raise ValueError("hosts must map names to [ip, mac]")
+    for name, h in hosts.items():
+        if not isinstance(h, (list, tuple)) or len(h) != 2:
+            raise ValueError("host %s: must be [ip, mac]" % (name,))
+        _address(h[0], "host %s" % (name,))
+        if not isinstance(h[1], str) or \
+                len(h[1].split(':')) != 6 or \
+                not all(len(x) == 2 and _hex(x) for x in h[1].split(':')):
+            raise ValueError("host %s: bad MAC %s" % (name, h[1]))
+    for b in _entries(policy, 'block', ('src', 'dst', 'proto', 'port',
+                                        'allow')):
+        _check_entry(hosts, b, "block entry")
+    for q in _entries(policy, 'qos', ('src', 'dst', 'proto', 'port',
+                                      'queue')):
+        _check_entry(hosts, q, "qos entry")
+        if not isinstance(q.get('queue'), int) or q['queue'] < 0:
+            raise ValueError("qos entry %s: needs a queue number" % (q,))
+    routes = policy.get('routes')
+    if not isinstance(routes, list):
+        raise ValueError("routes must be a list")
+    for r in routes:
+        if not isinstance(r, (list, tuple)) or len(r) != 4:
+            raise ValueError("route %s: must be [prefix, gateway, port, host]"
+                             % (r,))
+        try:
+            ipaddress.IPv4Network(str(r[0]), strict=False)
+        except ValueError:
+            raise ValueError("route %s: bad prefix %s" % (r, r[0]))
+        _address(r[1], "route %s" % (r[0],))
+        if not isinstance(r[2], int) or not 0 < r[2] < 0xff00:
+            raise ValueError("route %s: bad port %s" % (r[0], r[2]))
+        if r[3] not in hosts:
+            raise ValueError("route %s: unknown host %s" % (r[0], r[3]))
+
+
+def _hex(x):
+    try:
+        int(x, 16)
+    except ValueError:
+        return False
+    return True
+
+
+def _address(ip, what):
+    try:
+        ipaddress.IPv4Address(str(ip))
+    except ValueError:
+        raise ValueError("%s: bad address %s" % (what, ip))
+
+
+# the entries of policy[name], each checked to be an object with only
+# the keys known
+def _entries(policy, name, known):
+    entries = policy.get(name, [])
+    if not isinstance(entries, list):
+        raise ValueError("%s must be a list" % (name,))
+    for e in entries:
+        if not isinstance(e, dict) or set(e) - set(known):
+            raise ValueError("%s entry %s: must be an object with keys "
+                             "among %s" % (name, e, ', '.join(known)))
+    return entries
+
+
+def _check_entry(hosts, e, what):
+    for k in ('src', 'dst'):
+        if k in e and e[k] not in hosts:
+            raise ValueError("%s %s: unknown host %s" % (what, e, e[k]))
+    if 'proto' in e and e['proto'] not in PROTOCOLS and \
+            not (isinstance(e['proto'], int) and 0 <= e['proto'] < 256):
+        raise ValueError("%s %s: unknown protocol" % (what, e))
+    if 'port' in e:
+        if e.get('proto') not in ('tcp', 'udp', 6, 17):
+            raise ValueError("%s %s: port needs tcp or udp" % (what, e))
+        if not isinstance(e['port'], int) or not 0 <= e['port'] < 65536:
+            raise ValueError("%s %s: bad port" % (what, e))
+
+
+def _match(**fields):
+    return tuple(sorted(fields.items()))
+
+
+# flood all communications going to through the net, dropping the rest
+def allow_all():
+    return {(ACL_TABLE, FLOOD_PRIORITY, ()): (('output', FLOOD),),
+            (ACL_TABLE, DROP_PRIORITY, ()): ()}
+
+
+# the match fields of a block list entry
+def _entry(hosts, b):
+    m = {'dl_type': 0x800}
+    if 'src' in b:
+        m['nw_src'] = hosts[b['src']][0]
+    if 'dst' in b:
+        m['nw_dst'] = hosts[b['dst']][0]
+    if 'proto' in b:
+        m['nw_proto'] = PROTOCOLS.get(b['proto'], b['proto'])
+    if 'port' in b:
+        m['tp_dst'] = b['port']
+    return m
+
+
+# drop everything the block list names; entries with "allow": true are
+# exceptions, they are let through to be forwarded by allowed
+def block(policy, allowed=(('output', CONTROLLER),)):
+    hosts = policy['hosts']
+    rules = {}
+    for b in policy['block']:
+        if b.get('allow'):
+            rules[(ACL_TABLE, ALLOW_PRIORITY,
+                   _match(**_entry(hosts, b)))] = tuple(allowed)
+        else:
+            rules[(ACL_TABLE, BLOCK_PRIORITY, _match(**_entry(hosts, b)))] = ()
+    return rules
+
+
+# the queue of the most specific qos entry that covers a flow (as the
+# compiled rules would pick it), None if none; the flow's fields are
+# IPs/numbers, None where it doesn't fix them
+def queue(policy, proto, src, dst, port):
+    hosts = policy['hosts']
+    want = {'dl_type': 0x800, 'nw_src': src, 'nw_dst': dst,
+            'nw_proto': proto, 'tp_dst': port}
+    best = None
+    for q in policy.get('qos', ()):
+        m = _entry(hosts, q)
+        if all(want[k] is not None and str(want[k]) == str(v)
+               for k, v in m.items()):
+            if best is None or len(m) > best[0]:
+                best = (len(m), q['queue'])
+    return None if best is None else best[1]
+
+
+# do qos entries put some of src -> dst's traffic (by protocol or port)
+# in another queue than the rest?  Then one rule for the whole pair
+# can't keep them apart
+def splits_pair(policy, src, dst):
+    hosts = policy['hosts']
+    whole = queue(policy, None, src, dst, None)
+    for q in policy.get('qos', ()):
+        if 'proto' not in q and 'port' not in q:
+            continue
+        m = _entry(hosts, q)
+        if all(str(m[k]) == str(v) for k, v in (('nw_src', src),
+                                                 ('nw_dst', dst)) if k in m) \
+                and q['queue'] != whole:
+            return True
+    return False
+
+
+# what a router does with a packet it sends to mac behind port
+def route_actions(port, mac, router_mac, queue=None):
+    return (('set_src', router_mac),
+            ('set_dst', mac),
+            ('dec_ttl',),
+            ('output', port) if queue is None else ('enqueue', port, queue))
+
+
+# one rule per prefix, more specific prefixes first
+def routes(policy, router_mac, table=ACL_TABLE):
+    hosts = policy['hosts']
+    return dict(((table, ROUTE_PRIORITY + int(r[0].split('/')[1]),
+                  _match(dl_type=0x800, nw_dst=r[0])),
+                 route_actions(r[2], hosts[r[3]][1], router_mac))
+                for r in policy['routes'])
+
+
+# the qos entries naming a destination, each along the route to it if
+# that goes out of one of queue_ports
+def qos_routes(policy, router_mac, queue_ports, table=ACL_TABLE):
+    hosts = policy['hosts']
+    nets = [(ipaddress.IPv4Network(r[0]), r) for r in policy['routes']]
+    rules = {}
+    for q in policy.get('qos', ()):
+        if 'dst' not in q:
+            continue
+        ip = ipaddress.IPv4Address(hosts[q['dst']][0])
+        hits = sorted([(n, r) for n, r in nets if ip in n],
+                      key=lambda nr: -nr[0].prefixlen)
+        if not hits or hits[0][1][2] not in queue_ports:
+            continue
+        r = hits[0][1]
+        key = (table, QOS_PRIORITY + len(_entry(hosts, q)),
+               _match(**_entry(hosts, q)))
+        rules.setdefault(key, route_actions(r[2], hosts[r[3]][1], router_mac,
+                                            q['queue']))
+    return rules
+
+
+# the exceptions of the block list, crossed with the routes they may
+# take: all a single table can do when permitting means forwarding
+def _allowed_routes(policy, router_mac):
+    hosts = policy['hosts']
+    nets = [(ipaddress.IPv4Network(r[0]), r) for r in policy['routes']]
+    rules = {}
+    for b in policy['block']:
+        if not b.get('allow'):
+            continue
+        m = _entry(hosts, b)
+        if 'nw_dst' in m:                   # just the route it would take
+            ip = ipaddress.IPv4Address(m['nw_dst'])
+            hits = [(n, r) for n, r in nets if ip in n]
+            hits = sorted(hits, key=lambda nr: -nr[0].prefixlen)[:1]
+        else:
+            hits = nets
+        for n, r in hits:
+            f = dict(m)
+            f.setdefault('nw_dst', r[0])
+            rules[(ACL_TABLE, ALLOW_PRIORITY + n.prefixlen, _match(**f))] = \
+                route_actions(r[2], hosts[r[3]][1], router_mac)
+    return rules
+
+
+# the rules of the core switch; queue_ports have queues for qos
+def core(policy, routed=False, router_mac=None, pipeline=False,
+         queue_ports=()):
+    if pipeline:
+        # table 0 decides, table 1 forwards; what table 1 doesn't know
+        # goes to the controller to be learned
+        rules = block(policy, allowed=(('resubmit', FORWARD_TABLE),))
+        rules[(ACL_TABLE, MISS_PRIORITY, ())] = (('resubmit', FORWARD_TABLE),)
+        rules[(FORWARD_TABLE, MISS_PRIORITY, ())] = (('output', CONTROLLER),)
+        if routed:
+            rules.update(routes(policy, router_mac, FORWARD_TABLE))
+            rules.update(qos_routes(policy, router_mac, queue_ports,
+                                    FORWARD_TABLE))
+        return rules
+    if not routed:
+        return block(policy)
+    rules = dict((k, a) for k, a in block(policy).items()
+                 if k[1] != ALLOW_PRIORITY)
+    rules.update(_allowed_routes(policy, router_mac))
+    rules.update(routes(policy, router_mac))
+    rules.update(qos_routes(policy, router_mac, queue_ports))
+    return rules
+
+
+# what to send to go from rule set old to new: (add, modify, delete),
+# each a list of (table, priority, match, actions)
+def diff(old, new):
+    add, modify, delete = [], [], []
+    for key, actions in new.items():
+        if key not in old:
+            add.append(key + (actions,))
+        elif old[key] != actions:
+            modify.append(key + (actions,))
+    for key, actions in old.items():
+        if key not in new:
+            delete.append(key + (actions,))
+    return add, modify, delete
@@ -0,0 +1,136 @@
+# Control channel latency for Part4Controller
+#
+# echo requests measure the switch agent and the channel alone, barriers
+# measure them plus the flow_mods queued ahead; a barrier right after a
+# learned flow gives the switch's share of flow setup, the time spent in
+# _handle_PacketIn gives the controller's
+
+import clock
+
+ECHO = 'echo'               # echo request/reply round trip
+BARRIER = 'barrier'         # barrier request/reply round trip
+SWITCH = 'switch'           # flow_mod until the switch confirms it
+CONTROLLER = 'controller'   # PacketIn received until its flow_mod is sent
+
+
+class Histogram (object):
+    """
+    Latencies in power-of-two buckets of microseconds: fixed size, and
+    percentiles good to within a factor of two.
+    """
+
+    BUCKETS = 32
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        us = int(seconds * 1e6)
+        self.counts[min(us.bit_length(), self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    # upper bound (seconds) of the bucket holding percentile p (0-100)
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        want, seen = self.count * p / 100.0, 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if c and seen >= want:
+                return (1 << i) / 1e6
+        return self.max
+
+    def summary(self):
+        return {'count': self.count,
+                'mean_ms': self.total / self.count * 1000 if self.count else 0,
+                'p50_ms': self.percentile(50) * 1000,
+                'p99_ms': self.percentile(99) * 1000,
+                'max_ms': self.max * 1000}
+
+
+class LatencyProbes (object):
+    """
+    Outstanding probes and latency histograms of one connection.
+
+    The connection counts as degraded while the moving average of its
+    echo round trips is degraded times its best one (and above floor
+    seconds), or from the time a probe of kind health goes unanswered
+    for timeout seconds until one is answered again.
+    """
+
+    def __init__(self, degraded=4.0, floor=0.005, timeout=5.0, alpha=0.2,
+                 health=ECHO):
+        self.factor = degraded
+        self.floor = floor
+        self.timeout = timeout
+        self.alpha = alpha
+        self.health = health                # BARRIER where echoes can't be
+        self.hist = dict((k, Histogram())
+                         for k in (ECHO, BARRIER, SWITCH, CONTROLLER))
+        self.lost = 0
+        self.degraded = False
+        self._missing = False               # health probe lost, none since
+        self._told = False                  # degraded, as expire last said
+        self._pending = {}                  # map: xid to (kind, sent at)
+        self._avg = None                    # moving average echo rtt
+        self._best = None                   # lowest echo rtt seen
+
+    def sent(self, xid, kind, now=None):
+        self._pending[xid] = (kind, clock.now() if now is None else now)
+
+    # is a probe of kind still waiting for its answer?
+    def waiting(self, kind):
+        return any(k == kind for k, t in self._pending.values())
+
+    # the answer to xid came in; returns its kind, None if not ours
+    def answered(self, xid, now=None):
+        p = self._pending.pop(xid, None)
+        if p is None:
+            return None
+        kind, sent = p
+        rtt = (clock.now() if now is None else now) - sent
+        self.hist[kind].add(rtt)
+        if kind == ECHO:
+            self._avg = rtt if self._avg is None else \
+                self.alpha * rtt + (1 - self.alpha) * self._avg
+            self._best = rtt if self._best is None else min(self._best, rtt)
+        if kind == self.health:
+            self._missing = False
+        self._check()
+        return kind
+
+    def add(self, kind, seconds):
+        self.hist[kind].add(seconds)
+
+    # forget probes older than timeout; returns True if health changed
+    # since the last call
+    def expire(self, now=None):
+        now = clock.now() if now is None else now
+        late = [x for x, (k, t) in self._pending.items()
+                if now - t > self.timeout]
+        for x in late:
+            kind = self._pending.pop(x)[0]
+            self.lost += 1
+            if kind == self.health:
+                self._missing = True
+        self._check()
+        was, self._told = self._told, self.degraded
+        return was != self.degraded
+
+    def _check(self):
+        slow = self._avg is not None and self._avg > self.floor and \
+            self._avg > self.factor * self._best
+        self.degraded = self._missing or slow
+
+    def summary(self):
+        s = dict((k, h.summary()) for k, h in self.hist.items())
+        s['lost'] = self.lost
+        s['outstanding'] = len(self._pending)
+        s['degraded'] = self.degraded
+        s['echo_avg_ms'] = (self._avg or 0) * 1000
+        return s
@@ -0,0 +1,306 @@
+# Record and replay the OpenFlow messages of Part4Controller
+#
+# every message to and from each switch is appended, packed, to a
+# memory-mapped ring file; the ring is a row of fixed-size segments,
+# the oldest segment is overwritten when the file is full.  A recorded
+# session can be fed back into Part4Controller as fast as it can go,
+# with clock.py following the recorded timestamps and the xids of the
+# replies mapped onto the requests it sends now, so it decides as it did
+# when the recording was made:
+#
+#   ./pox.py part4controller recorder --record=/tmp/of.ring
+#   ./pox.py part4controller recorder --replay_file=/tmp/of.ring
+
+import mmap
+import os
+import struct
+import time
+
+from pox.core import core
+import pox.openflow.libopenflow_01 as of
+from pox.openflow import (PacketIn, FlowRemoved, PortStatus, BarrierIn,
+                          ErrorIn, RawStatsReply, QueueStatsReceived)
+
+import clock
+
+log = core.getLogger()
+
+IN = 0                      # switch -> controller
+OUT = 1                     # controller -> switch
+
+MAGIC = b'OFRING1\0'
+FILE_HDR = struct.Struct('<8sII')       # magic, segment size, segments
+SEG_HDR = struct.Struct('<QI4x')        # sequence (0 = unused), bytes used
+REC_HDR = struct.Struct('<dQBI')        # time, dpid, direction, length
+XID = struct.Struct('!I')               # at 4 in every OpenFlow header
+
+# inbound messages worth recording, with the events that carry them
+EVENTS = {
+    'PacketIn': PacketIn,
+    'FlowRemoved': FlowRemoved,
+    'PortStatus': PortStatus,
+    'BarrierIn': BarrierIn,
+    'ErrorIn': ErrorIn,
+    'RawStatsReply': RawStatsReply,
+}
+
+# how to unpack what is replayed
+MESSAGES = {
+    of.OFPT_PACKET_IN: (of.ofp_packet_in, 'PacketIn'),
+    of.OFPT_FLOW_REMOVED: (of.ofp_flow_removed, 'FlowRemoved'),
+    of.OFPT_PORT_STATUS: (of.ofp_port_status, 'PortStatus'),
+    of.OFPT_BARRIER_REPLY: (of.ofp_barrier_reply, 'BarrierIn'),
+    of.OFPT_ERROR: (of.ofp_error, 'ErrorIn'),
+}
+
+# messages the controller's timers send as well as its event handlers;
+# timers don't run during a replay, so these aren't compared
+TIMED = (of.OFPT_ECHO_REQUEST, of.OFPT_BARRIER_REQUEST,
+         of.OFPT_STATS_REQUEST)
+
+
+class Recorder (object):
+    """
+    Appends (time, dpid, direction, message) records to a ring file.
+
+    A record costs one struct.pack_into and one slice copy into the
+    mapping; nothing is flushed until the recorder is closed.
+    """
+
+    def __init__(self, path, size=64 << 20, segment=1 << 20):
+        self.segment = segment
+        self.segments = max(2, size // segment)
+        length = FILE_HDR.size + self.segments * segment
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, length)
+            self._map = mmap.mmap(fd, length)
+        finally:
+            os.close(fd)
+        FILE_HDR.pack_into(self._map, 0, MAGIC, segment, self.segments)
+        self._seq = 0
+        self._open_segment(0)
+        self.records = 0
+        self.dropped = 0                    # larger than a segment
+
+    def _open_segment(self, i):
+        self._seq += 1
+        self._index = i
+        self._base = FILE_HDR.size + i * self.segment
+        self._used = 0
+        SEG_HDR.pack_into(self._map, self._base, self._seq, 0)
+
+    def record(self, dpid, direction, data, now=None):
+        n = REC_HDR.size + len(data)
+        if n > self.segment - SEG_HDR.size:
+            self.dropped += 1
+            return
+        if self._used + n > self.segment - SEG_HDR.size:
+            self._open_segment((self._index + 1) % self.segments)
+        at = self._base + SEG_HDR.size + self._used
+        REC_HDR.pack_into(self._map, at, time.time() if now is None else now,
+                          dpid, direction, len(data))
+        self._map[at + REC_HDR.size:at + n] = data
+        self._used += n
+        SEG_HDR.pack_into(self._map, self._base, self._seq, self._used)
+        self.records += 1
+
+    def close(self):
+        self._map.flush()
+        self._map.close()
+
+    # record everything sent on connection, and everything core.openflow
+    # raises for it
+    def attach(self, nexus):
+        def up(event):
+            con = event.connection
+            send = con.send
+            dpid = con.dpid
+
+            def recording_send(data):
+                if not isinstance(data, bytes):
+                    data = data.pack()      # pack once, send the bytes
+                self.record(dpid, OUT, data)
+                send(data)
+            con.send = recording_send
+            self.record(dpid, IN, event.ofp.pack())
+            # POX raises no event for echo replies: wrap their handler
+            handlers = getattr(con, 'handlers', None)
+            if isinstance(handlers, list) and \
+                    len(handlers) > of.OFPT_ECHO_REPLY:
+                handlers = list(handlers)
+                old = handlers[of.OFPT_ECHO_REPLY]
+
+                def echo_reply(*args):
+                    self.record(dpid, IN, args[-1].pack())
+                    if old is not None:
+                        old(*args)
+                handlers[of.OFPT_ECHO_REPLY] = echo_reply
+                con.handlers = handlers
+
+        def inbound(event):
+            self.record(event.connection.dpid, IN, event.ofp.pack())
+
+        # ahead of the controller, so its setup rules are recorded too
+        nexus.addListenerByName("ConnectionUp", up, priority=1)
+        for name in EVENTS:
+            nexus.addListenerByName(name, inbound, priority=1)
+
+
+# yields (time, dpid, direction, data) from a ring file, oldest first
+def read_records(path):
+    with open(path, 'rb') as f:
+        buf = f.read()
+    magic, segment, segments = FILE_HDR.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError("%s is not a recording" % (path,))
+    order = []
+    for i in range(segments):
+        base = FILE_HDR.size + i * segment
+        seq, used = SEG_HDR.unpack_from(buf, base)
+        if seq:
+            order.append((seq, base, used))
+    for seq, base, used in sorted(order):
+        at, end = base + SEG_HDR.size, base + SEG_HDR.size + used
+        while at < end:
+            ts, dpid, direction, n = REC_HDR.unpack_from(buf, at)
+            at += REC_HDR.size
+            yield ts, dpid, direction, buf[at:at + n]
+            at += n
+
+
+class _ReplayConnection (object):
+    """
+    Stands in for a switch connection: delivers replayed events to the
+    listeners and counts what the controller sends back.
+    """
+
+    def __init__(self, dpid):
+        self.dpid = dpid
+        self.sent = {}                      # map: OFPT type to count
+        self.out = []                       # (type, xid)s not yet paired
+        self.handlers = [None] * (of.OFPT_ECHO_REPLY + 1)  # see _hook_echo
+        self._listeners = []
+
+    def addListeners(self, obj):
+        self._listeners.append(obj)
+
+    def send(self, data):
+        if not isinstance(data, bytes):
+            data = data.pack()
+        t = data[1]
+        self.sent[t] = self.sent.get(t, 0) + 1
+        self.out.append((t, XID.unpack_from(data, 4)[0]))
+
+    def raiseEvent(self, name, event):
+        for obj in self._listeners:
+            h = getattr(obj, '_handle_' + name, None)
+            if h is not None:
+                h(event)
+
+
+# the inbound message data, unpacked and handed to con's listeners
+def _deliver(con, t, data):
+    if t == of.OFPT_ECHO_REPLY:
+        msg = of.ofp_echo_reply()
+        msg.unpack(data)
+        if con.handlers[t] is not None:
+            con.handlers[t](con, msg)
+        return True
+    if t == of.OFPT_STATS_REPLY:
+        msg = of.ofp_stats_reply()
+        msg.unpack(data)
+        if msg.type == of.OFPST_QUEUE:      # the only stats it asks for
+            con.raiseEvent('QueueStatsReceived',
+                           QueueStatsReceived(con, msg, msg.body))
+        return True
+    if t not in MESSAGES:
+        return False
+    cls, name = MESSAGES[t]
+    msg = cls()
+    msg.unpack(data)
+    con.raiseEvent(name, EVENTS[name](con, msg))
+    return True
+
+
+# what is compared of counts (map: OFPT type to count)
+def _compared(counts):
+    return dict((t, n) for t, n in counts.items() if t not in TIMED)
+
+
+# feed the recording at path into new instances of controller, one per
+# dpid, with clock.now() at each message's recorded time; returns
+# (inbound messages replayed, seconds, connections)
+#
+# what the controller sends while it handles a message was recorded
+# right after that message, in the same order, ahead of anything its
+# timers sent; so the recorded requests there are paired with the
+# replay's, one by one while their types agree, and the xids of the
+# replies to them are rewritten to the replay's before delivery
+def replay(path, controller):
+    cons = {}
+    expected = {}                           # map: dpid to {OFPT type: count}
+    xids = {}                               # map: dpid to {recorded: replay}
+    count = 0
+    at = [0.0]                              # time of the current record
+    start = time.time()
+    clock.use(lambda: at[0])
+    try:
+        for ts, dpid, direction, data in read_records(path):
+            t = data[1]
+            if direction == OUT:
+                e = expected.setdefault(dpid, {})
+                e[t] = e.get(t, 0) + 1
+                con = cons.get(dpid)
+                if con is not None and con.out:
+                    if con.out[0][0] == t:
+                        xids.setdefault(dpid, {})[
+                            XID.unpack_from(data, 4)[0]] = con.out.pop(0)[1]
+                    else:                       # a timer's, or diverged
+                        del con.out[:]
+                continue
+            at[0] = ts
+            if t == of.OFPT_FEATURES_REPLY:     # the switch (re)connected
+                cons[dpid] = _ReplayConnection(dpid)
+                xids[dpid] = {}
+                controller(cons[dpid])
+                continue
+            if dpid not in cons:
+                continue
+            del cons[dpid].out[:]
+            xid = xids.get(dpid, {}).get(XID.unpack_from(data, 4)[0])
+            if xid is not None:
+                data = data[:4] + XID.pack(xid) + data[8:]
+            if _deliver(cons[dpid], t, data):
+                count += 1
+    finally:
+        clock.use(None)
+    took = time.time() - start
+    for dpid, con in cons.items():
+        sent, want = _compared(con.sent), _compared(expected.get(dpid, {}))
+        if sent != want:
+            log.warning("dpid %s: replay sent %s, recording has %s",
+                        dpid, sent, want)
+    return count, took, cons
+
+
+def launch(record=None, replay_file=None, size=64):
+    """
+    --record=path records every OpenFlow message into a ring file of
+    size MB; --replay_file=path feeds a recording into Part4Controller
+    instead of talking to switches
+    """
+    if record:
+        r = Recorder(record, size=int(size) << 20)
+        r.attach(core.openflow)
+        core.addListenerByName("GoingDownEvent", lambda e: r.close())
+        log.info("Recording OpenFlow messages to %s", record)
+    if replay_file:
+        from part4controller import Part4Controller
+
+        def go(event):
+            n, took, cons = replay(replay_file, Part4Controller)
+            log.info("Replayed %d messages for %d switches in %.3fs "
+                     "(%.0f msg/s)", n, len(cons), took,
+                     n / took if took else 0)
+        core.addListenerByName("UpEvent", go)
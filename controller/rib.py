@@ -0,0 +1,163 @@
+# Routing table (RIB) for Part4Controller
+#
+# a path-compressed binary trie over IPv4 prefixes with longest prefix
+# match; each prefix carries the gateway address the hosts in it use
+# and where cores21 sends traffic for it
+
+import ipaddress
+
+
+# IPv4 address (string, IPAddr, int) as an unsigned int
+def to_int(addr):
+    if isinstance(addr, int):
+        return addr
+    return int(ipaddress.IPv4Address(str(addr)))
+
+
+# "a.b.c.d/n" as (network int, n)
+def parse_prefix(prefix):
+    net = ipaddress.IPv4Network(str(prefix), strict=False)
+    return int(net.network_address), net.prefixlen
+
+
+def _mask(length):
+    return (0xffffffff << (32 - length)) & 0xffffffff if length else 0
+
+
+def _bit(addr, i):
+    return (addr >> (31 - i)) & 1
+
+
+# number of leading bits a and b share, up to limit
+def _common(a, b, limit):
+    diff = (a ^ b) & _mask(limit)
+    if not diff:
+        return limit
+    return 32 - diff.bit_length()
+
+
+class Route (object):
+    """
+    A prefix, the gateway address its hosts use, the output port and
+    the MAC of the next hop behind that port.
+    """
+    __slots__ = ('network', 'length', 'gateway', 'port', 'mac')
+
+    def __init__(self, prefix, gateway, port, mac):
+        self.network, self.length = parse_prefix(prefix)
+        self.gateway = gateway
+        self.port = port
+        self.mac = mac
+
+    @property
+    def prefix(self):
+        return "%s/%d" % (ipaddress.IPv4Address(self.network), self.length)
+
+    def __repr__(self):
+        return "Route(%s via port %s)" % (self.prefix, self.port)
+
+
+class _Node (object):
+    __slots__ = ('network', 'length', 'route', 'children')
+
+    def __init__(self, network, length, route=None):
+        self.network = network
+        self.length = length
+        self.route = route
+        self.children = [None, None]
+
+
+class RoutingTable (object):
+    """
+    Longest prefix match over a path-compressed trie: a lookup visits at
+    most one node per distinct prefix length on the path, never one per
+    bit, and never one per host.
+    """
+
+    def __init__(self, routes=()):
+        self._root = _Node(0, 0)
+        self._gateways = {}                 # map: gateway int to Route
+        self._count = 0
+        for r in routes:
+            self.add(r)
+
+    def add(self, route):
+        net, length = route.network & _mask(route.length), route.length
+        node = self._root
+        while True:
+            if node.length == length:       # same prefix, replace
+                if node.route is None:
+                    self._count += 1
+                elif node.route.gateway is not None:
+                    self._gateways.pop(to_int(node.route.gateway), None)
+                node.route = route
+                break
+            b = _bit(net, node.length)
+            child = node.children[b]
+            if child is None:
+                node.children[b] = _Node(net, length, route)
+                self._count += 1
+                break
+            common = _common(net, child.network, min(length, child.length))
+            if common == child.length:      # child is on our path
+                node = child
+                continue
+            # split: a new node for the shared part of both prefixes
+            split = _Node(net & _mask(common), common)
+            split.children[_bit(child.network, common)] = child
+            node.children[b] = split
+            if common == length:
+                split.route = route
+            else:
+                split.children[_bit(net, common)] = _Node(net, length, route)
+            self._count += 1
+            break
+        if route.gateway is not None:
+            self._gateways[to_int(route.gateway)] = route
+
+    def remove(self, prefix):
+        net, length = parse_prefix(prefix)
+        node = self._root
+        while node is not None and node.length < length:
+            node = node.children[_bit(net, node.length)]
+            if node is not None and _common(net, node.network,
+                                            min(length, node.length)) \
+                    < min(length, node.length):
+                return None
+        if node is None or node.length != length or node.route is None:
+            return None
+        route, node.route = node.route, None
+        self._count -= 1
+        if route.gateway is not None:
+            self._gateways.pop(to_int(route.gateway), None)
+        return route
+
+    # the most specific route covering addr, or None
+    def lookup(self, addr):
+        addr = to_int(addr)
+        node, best = self._root, None
+        while node is not None:
+            if (addr ^ node.network) & _mask(node.length):
+                break                       # diverged from this branch
+            if node.route is not None:
+                best = node.route
+            if node.length == 32:
+                break
+            node = node.children[_bit(addr, node.length)]
+        return best
+
+    # the route whose gateway address is addr, or None
+    def gateway(self, addr):
+        return self._gateways.get(to_int(addr))
+
+    def routes(self):
+        out, stack = [], [self._root]
+        while stack:
+            node = stack.pop()
+            if node.route is not None:
+                out.append(node.route)
+            stack.extend(c for c in node.children if c is not None)
+        return sorted(out, key=lambda r: (r.network, r.length))
+
+    def __len__(self):
+        return self._count
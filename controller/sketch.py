@@ -0,0 +1,148 @@
+# Heavy-hitter detection for Part4Controller
+#
+# a count-min sketch estimates how often each key was seen, a small heap
+# keeps the k keys with the largest estimates; memory is fixed by
+# (width, depth, k) however many distinct keys go by
+
+import heapq
+import random
+import zlib
+
+import clock
+
+PRIME = (1 << 61) - 1       # for the row hashes
+
+
+class CountMinSketch (object):
+    """
+    depth rows of width counters; a key's estimate is the smallest of
+    its counters, never below its true count.  The same seed gives the
+    same hashes in every process, so a replay (recorder.py) sees the
+    same estimates as the recorded run.
+    """
+
+    def __init__(self, width=1024, depth=4, seed=0):
+        self.width = width
+        self.depth = depth
+        self._rows = [[0] * width for _ in range(depth)]
+        # one independent (a * h + b) mod PRIME hash per row; salting
+        # hash() itself gives rows that all collide together
+        rand = random.Random(seed)
+        self._hashes = [(rand.randrange(1, PRIME), rand.randrange(PRIME))
+                        for _ in range(depth)]
+
+    def _indexes(self, key):
+        # not hash(): str and bytes hashes change from process to process
+        h = zlib.crc32(repr(key).encode())
+        return [((a * h + b) % PRIME) % self.width for a, b in self._hashes]
+
+    def add(self, key, n=1):
+        est = None
+        for row, i in zip(self._rows, self._indexes(key)):
+            row[i] += n
+            if est is None or row[i] < est:
+                est = row[i]
+        return est
+
+    def estimate(self, key):
+        return min(row[i] for row, i in zip(self._rows, self._indexes(key)))
+
+    def clear(self):
+        for row in self._rows:
+            row[:] = [0] * self.width
+
+
+class TopK (object):
+    """
+    The k keys with the largest counts offered so far.
+    """
+
+    def __init__(self, k=10):
+        self.k = k
+        self._counts = {}                   # map: key to count
+        self._heap = []                     # (count, seq, key), may be stale
+        self._seq = 0                       # keeps keys out of comparisons
+
+    def offer(self, key, count):
+        if key in self._counts:
+            self._counts[key] = count
+        elif len(self._counts) < self.k:
+            self._counts[key] = count
+        else:
+            low = self._min()
+            if count <= low[0]:
+                return
+            heapq.heappop(self._heap)
+            del self._counts[low[1]]
+            self._counts[key] = count
+        self._seq += 1
+        heapq.heappush(self._heap, (count, self._seq, key))
+        if len(self._heap) > 4 * self.k:    # drop stale entries
+            self._heap = [(c, i, k) for i, (k, c)
+                          in enumerate(self._counts.items())]
+            heapq.heapify(self._heap)
+
+    # the (count, key) with the smallest current count
+    def _min(self):
+        while True:
+            c, _, key = self._heap[0]
+            if self._counts.get(key) == c:
+                return c, key
+            heapq.heappop(self._heap)
+
+    def __contains__(self, key):
+        return key in self._counts
+
+    def items(self):
+        return sorted(self._counts.items(), key=lambda kc: -kc[1])
+
+    def clear(self):
+        self._counts.clear()
+        del self._heap[:]
+
+
+class HeavyHitters (object):
+    """
+    Top-k keys over windows of window seconds.  top() reports the last
+    full window, with each key's rate per second over it.
+    """
+
+    def __init__(self, k=10, window=10, width=1024, depth=4, seed=0):
+        self.window = window
+        self._sketch = CountMinSketch(width, depth, seed)
+        self._top = TopK(k)
+        self._start = clock.now()
+        self._last = []                     # [(key, count, rate)]
+        self.total = 0                      # keys seen in this window
+
+    def add(self, key, now=None):
+        now = clock.now() if now is None else now
+        if now - self._start >= self.window:
+            self._roll(now)
+        self._top.offer(key, self._sketch.add(key))
+        self.total += 1
+
+    def _roll(self, now):
+        span = now - self._start
+        self._last = [(key, c, c / span) for key, c in self._top.items()]
+        self._sketch.clear()
+        self._top.clear()
+        self._start = now
+        self.total = 0
+
+    def top(self, now=None):
+        now = clock.now() if now is None else now
+        if now - self._start >= self.window:
+            self._roll(now)
+        return list(self._last)
+
+    # top() without starting a new window: safe from other threads
+    def last(self):
+        return list(self._last)
+
+    # is key among the top talkers, at rate or more per second?
+    def heavy(self, key, rate):
+        for k, c, r in self._last:
+            if k == key:
+                return r >= rate
+        return False
@@ -0,0 +1,116 @@
+# Switch graph for Part4Controller's fast failover
+#
+# links come and go one at a time (LLDP discovery, PortStatus, a switch
+# disconnecting); after each change the spanning tree that flooding may
+# use and, for every link of the root (the learning switch), the port
+# to fall back on if that link fails are worked out again, so that on a
+# failure the controller only has to look the backup up
+
+from collections import deque
+
+
+class Topology (object):
+    """
+    Switches and the links between them, a spanning tree rooted at root,
+    and backup first hops for the links of root.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.version = 0                    # bumped on every change
+        self._links = {}                    # map: (dpid, port) to (dpid, port)
+        self._tree = set()                  # (dpid, port)s on the tree
+        self._backups = {}                  # map: root port to backup port
+
+    def __len__(self):
+        return len(self._links) // 2
+
+    def peer(self, dpid, port):
+        return self._links.get((dpid, port))
+
+    # ports of dpid that lead to another switch
+    def switch_ports(self, dpid):
+        return set(p for d, p in self._links if d == dpid)
+
+    def links(self):
+        return sorted(k + v for k, v in list(self._links.items()) if k < v)
+
+    # returns True if the link is new
+    def link_up(self, dpid1, port1, dpid2, port2):
+        if self._links.get((dpid1, port1)) == (dpid2, port2):
+            return False
+        for end in ((dpid1, port1), (dpid2, port2)):  # ports moved
+            old = self._links.pop(end, None)
+            if old is not None:
+                self._links.pop(old, None)
+        self._links[(dpid1, port1)] = (dpid2, port2)
+        self._links[(dpid2, port2)] = (dpid1, port1)
+        self._changed()
+        return True
+
+    # the link on (dpid, port) is gone; returns it, None if there was none
+    def link_down(self, dpid, port):
+        peer = self._links.pop((dpid, port), None)
+        if peer is None:
+            return None
+        self._links.pop(peer, None)
+        self._changed()
+        return (dpid, port) + peer
+
+    # should dpid flood out of port?  Host ports and tree ports do
+    def floods(self, dpid, port):
+        return (dpid, port) not in self._links or (dpid, port) in self._tree
+
+    # the port of root to use if the link on port fails, None if none
+    def backup(self, port):
+        return self._backups.get(port)
+
+    def _adjacent(self):
+        adj = {}
+        for (d, p), (d2, p2) in sorted(self._links.items()):
+            adj.setdefault(d, []).append((p, d2, p2))
+        return adj
+
+    def _changed(self):
+        self.version += 1
+        adj = self._adjacent()
+        # breadth first from root: shortest paths from the learning
+        # switch stay on the tree, so its unicast and the edge switches'
+        # floods never cross
+        self._tree = set()
+        seen, queue = set([self.root]), deque([self.root])
+        while queue:
+            d = queue.popleft()
+            for p, d2, p2 in adj.get(d, ()):
+                if d2 not in seen:
+                    seen.add(d2)
+                    self._tree.update(((d, p), (d2, p2)))
+                    queue.append(d2)
+        self._backups = {}
+        for p, d2, p2 in adj.get(self.root, ()):
+            first = _first_hop(adj, self.root, d2, (self.root, p))
+            if first is not None:
+                self._backups[p] = first
+
+
+# the port src's shortest path to dst leaves by, without the link on
+# the port avoid; None if dst can't be reached then
+def _first_hop(adj, src, dst, avoid):
+    seen = set([src])
+    queue = deque()
+    for p, d2, p2 in adj.get(src, ()):
+        if (src, p) != avoid and d2 not in seen:
+            if d2 == dst:
+                return p
+            seen.add(d2)
+            queue.append((d2, p))
+    while queue:
+        d, first = queue.popleft()
+        for p, d2, p2 in adj.get(d, ()):
+            if (d2, p2) == avoid or d2 in seen:
+                continue
+            if d2 == dst:
+                return first
+            seen.add(d2)
+            queue.append((d2, first))
+    return None
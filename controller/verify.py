@@ -0,0 +1,402 @@
+# Static reachability check of the rules Part4Controller installs
+#
+# every switch's compiled flow table (policy.py) and the links between
+# switches and hosts are turned into a header-space model: sets of
+# packet headers are unions of ternary bit vectors ("cubes") over the
+# fields the rules match, and are pushed from each host through the
+# tables and links to see which headers reach which host, and by which
+# chain of rules.  Packets a learning switch sends to the controller are
+# taken to be forwarded towards their destination, as the controller
+# will once it has learned it (or refused, for reply-only sources).
+#
+#   python3 verify.py [policy.json] [--routed] [--pipeline] [--qos]
+#   python3 verify.py --bench 300
+
+import ipaddress
+import sys
+import time
+
+import policy
+
+# fields of the model, in bit order, with their widths
+FIELDS = (('dl_type', 16), ('nw_proto', 8), ('nw_src', 32), ('nw_dst', 32),
+          ('tp_src', 16), ('tp_dst', 16))
+_OFFSET = {}
+_at = 0
+for _name, _width in reversed(FIELDS):
+    _OFFSET[_name] = (_at, _width)
+    _at += _width
+del _at, _name, _width
+
+# the cube a (compiled) match covers: (value, mask), mask 1 = fixed bit
+def cube(match):
+    value = mask = 0
+    for name, v in match:
+        if name not in _OFFSET:
+            continue                        # in_port is handled apart
+        at, width = _OFFSET[name]
+        bits = width
+        if name in ('nw_src', 'nw_dst'):
+            net = ipaddress.IPv4Network(str(v), strict=False)
+            v, bits = int(net.network_address), net.prefixlen
+        m = ((1 << bits) - 1) << (width - bits)
+        value |= (v & m) << at
+        mask |= m << at
+    return value, mask
+
+
+def intersect(a, b):
+    if (a[0] ^ b[0]) & a[1] & b[1]:
+        return None
+    return (a[0] & a[1]) | (b[0] & b[1]), a[1] | b[1]
+
+
+# a minus b, as a list of disjoint cubes
+def subtract(a, b):
+    if intersect(a, b) is None:
+        return [a]
+    out = []
+    value, mask = a
+    free = b[1] & ~a[1]
+    while free:
+        bit = free & -free
+        free ^= bit
+        out.append(((value & ~bit) | (~b[0] & bit), mask | bit))
+        value, mask = (value & ~bit) | (b[0] & bit), mask | bit
+    return out
+
+
+def describe(c):
+    out = []
+    for name, width in FIELDS:
+        at = _OFFSET[name][0]
+        m = ((1 << width) - 1) << at
+        if not c[1] & m:
+            continue
+        fixed = (c[1] & m) >> at
+        v = (c[0] & m) >> at
+        if name in ('nw_src', 'nw_dst'):
+            bits = bin(fixed).count('1')
+            out.append('%s=%s/%d' % (name, ipaddress.IPv4Address(v), bits))
+        elif fixed == (1 << width) - 1:
+            out.append('%s=%s' % (name, v))
+        else:
+            out.append('%s~%x/%x' % (name, v, fixed))
+    return ','.join(out) or '*'
+
+
+class Network (object):
+    """
+    Switches with their compiled rules, hosts, and the links between.
+    """
+
+    def __init__(self):
+        self.rules = {}                     # map: dpid to sorted rule list
+        self.learning = set()               # dpids that ask the controller
+        self.hosts = {}                     # map: name to (ip, dpid, port)
+        self.links = {}                     # map: (dpid, port) to peer
+        self.ports = {}                     # map: dpid to set of ports
+        self.reply_only = set()             # host names, see conntrack.py
+        self.dst = {}                       # map: host name to its nw_dst cube
+
+    # rules as compiled by policy.py: {(table, priority, match): actions}
+    def add_switch(self, dpid, rules, learning=False):
+        # highest priority first, then a stable order
+        self.rules[dpid] = sorted(
+            ((t, p, m, cube(m), dict(m).get('in_port'), a)
+             for (t, p, m), a in rules.items()),
+            key=lambda r: (r[0], -r[1], r[2]))
+        self.ports.setdefault(dpid, set())
+        if learning:
+            self.learning.add(dpid)
+
+    def add_link(self, dpid1, port1, dpid2, port2):
+        self.links[(dpid1, port1)] = ('switch', dpid2, port2)
+        self.links[(dpid2, port2)] = ('switch', dpid1, port1)
+        self.ports.setdefault(dpid1, set()).add(port1)
+        self.ports.setdefault(dpid2, set()).add(port2)
+
+    def add_host(self, name, ip, dpid, port):
+        self.hosts[name] = (ip, dpid, port)
+        self.dst[name] = cube((('nw_dst', ip),))
+        self.links[(dpid, port)] = ('host', name, None)
+        self.ports.setdefault(dpid, set()).add(port)
+
+    # map: host name to the port dpid reaches it by (shortest path)
+    def next_hops(self, dpid):
+        hops, seen, frontier = {}, set([dpid]), []
+        for port in sorted(self.ports[dpid]):
+            frontier.append((self.links.get((dpid, port)), port))
+        while frontier:
+            nxt = []
+            for peer, first in frontier:
+                if peer is None:
+                    continue
+                if peer[0] == 'host':
+                    hops.setdefault(peer[1], first)
+                elif peer[1] not in seen:
+                    seen.add(peer[1])
+                    for port in sorted(self.ports[peer[1]]):
+                        if port != peer[2]:
+                            nxt.append((self.links.get((peer[1], port)), first))
+            frontier = nxt
+        return hops
+
+
+class Result (object):
+    """
+    What reached where: for each (src, dst) host pair the cubes that got
+    there with the rule chain each took, and the ones dropped on the way.
+    """
+
+    def __init__(self):
+        self.reached = {}                   # map: (src, dst) to [(cube, chain)]
+        self.dropped = {}                   # map: src to [(cube, chain)]
+
+    def reaches(self, src, dst):
+        return bool(self.reached.get((src, dst)))
+
+    def chains(self, src, dst):
+        return self.reached.get((src, dst), [])
+
+    # drops on the way from src of headers meant for dst (ip)
+    def drops(self, src, ip):
+        want = cube((('nw_dst', ip),))
+        return [(c, chain) for c, chain in self.dropped.get(src, [])
+                if intersect(c, want) is not None]
+
+
+class Verifier (object):
+    """
+    Pushes the IPv4 header space of each host through a Network.
+    """
+
+    def __init__(self, net, max_hops=64):
+        self.net = net
+        self.max_hops = max_hops
+        # map: learning dpid to {port: hosts behind it}
+        self._hops = {}
+        for d in net.learning:
+            for name, port in net.next_hops(d).items():
+                self._hops.setdefault(d, {}).setdefault(port, set()).add(name)
+
+    def run(self, sources=None):
+        result = Result()
+        for src in sorted(sources or self.net.hosts):
+            ip, dpid, port = self.net.hosts[src]
+            start = cube((('dl_type', 0x800), ('nw_src', ip)))
+            self._switch(result, (src, None), dpid, port, 0, [start], [], 0)
+        return result
+
+    # headers cubes of flow arrive at table of dpid on in_port; a flow
+    # is (source host, hosts it may still be delivered to or None for any)
+    def _switch(self, result, flow, dpid, in_port, table, cubes, chain, hops):
+        if hops > self.max_hops:
+            return
+        left = cubes
+        for t, prio, match, c, port, actions in self.net.rules.get(dpid, ()):
+            if t != table or (port is not None and port != in_port):
+                continue
+            hit = [x for x in (intersect(a, c) for a in left) if x is not None]
+            if not hit:
+                continue
+            step = chain + [(dpid, t, prio, match)]
+            self._act(result, flow, dpid, in_port, actions, hit, step, hops)
+            left = [d for a in left for d in subtract(a, c)]
+            if not left:
+                return
+        # table miss: the switch asks the controller
+        self._controller(result, flow, dpid, in_port, left,
+                         chain + [(dpid, table, 'miss', ())], hops)
+
+    def _act(self, result, flow, dpid, in_port, actions, cubes, chain, hops):
+        outs = []
+        for a in actions:
+            if a[0] in ('output', 'enqueue'):
+                outs.append(a[1])
+            elif a[0] == 'resubmit':
+                self._switch(result, flow, dpid, in_port, a[1], cubes, chain,
+                             hops)
+        if not actions:
+            result.dropped.setdefault(flow[0], []).extend((c, chain)
+                                                          for c in cubes)
+        for out in outs:
+            if out == policy.FLOOD:
+                for port in sorted(self.net.ports[dpid]):
+                    if port != in_port:
+                        self._link(result, flow, dpid, port, cubes, chain,
+                                   hops)
+            elif out == policy.CONTROLLER:
+                self._controller(result, flow, dpid, in_port, cubes, chain,
+                                 hops)
+            else:
+                self._link(result, flow, dpid, out, cubes, chain, hops)
+
+    # the controller forwards what a learning switch sends it towards its
+    # destination, unless the source may not open connections; rather
+    # than split the cubes per destination, the flow remembers which
+    # hosts the port it goes out of leads to
+    def _controller(self, result, flow, dpid, in_port, cubes, chain, hops):
+        src, to = flow
+        if dpid not in self.net.learning or src in self.net.reply_only:
+            result.dropped.setdefault(src, []).extend(
+                (c, chain + [(dpid, 'controller', 'drop', ())]) for c in cubes)
+            return
+        for port, names in sorted(self._hops[dpid].items()):
+            if port == in_port:
+                continue
+            names = names if to is None else names & to
+            if names:
+                self._link(result, (src, names), dpid, port, cubes,
+                           chain + [(dpid, 'controller', port, ())], hops)
+
+    def _link(self, result, flow, dpid, port, cubes, chain, hops):
+        peer = self.net.links.get((dpid, port))
+        if peer is None:
+            return
+        if peer[0] == 'host':
+            src, to = flow
+            if peer[1] == src or (to is not None and peer[1] not in to):
+                return
+            want = self.net.dst[peer[1]]
+            hit = [x for x in (intersect(a, want) for a in cubes)
+                   if x is not None]
+            if hit:
+                result.reached.setdefault((src, peer[1]), []).extend(
+                    (c, chain) for c in hit)
+            return
+        self._switch(result, flow, peer[1], peer[2], 0, cubes, chain, hops + 1)
+
+
+def format_chain(chain):
+    return ' -> '.join('s%s[%s/%s %s]' % (d, t, p, dict(m) or '*')
+                       for d, t, p, m in chain)
+
+
+# violations of "none of isolated (src, dst) pairs reach" and "every
+# member of connected reaches every other one", as readable strings;
+# reply-only members only answer, so they need only be reached
+def check(result, net, isolated=(), connected=()):
+    out = []
+    for src, dst in isolated:
+        # one line per chain, however many cubes the subtractions left
+        by_chain = {}
+        for c, chain in result.chains(src, dst):
+            by_chain.setdefault(tuple(chain), []).append(c)
+        for chain, cubes in sorted(by_chain.items(), key=str):
+            more = ' (and %d more)' % (len(cubes) - 1) if len(cubes) > 1 else ''
+            out.append("%s reaches %s with %s%s via %s" %
+                       (src, dst, describe(cubes[0]), more,
+                        format_chain(chain)))
+    for src in connected:
+        for dst in connected:
+            if src == dst or src in net.reply_only or \
+                    result.reaches(src, dst):
+                continue
+            why = result.drops(src, net.hosts[dst][0]) or [(None, [])]
+            out.append("%s can't reach %s: %s" %
+                       (src, dst, '; '.join(
+                           format_chain(chain) or 'no path'
+                           for c, chain in why[:3])))
+    return out
+
+
+# part4_topo: where the hosts are (their addresses are policy.IPS), and
+# how the switches are wired
+PART4_HOSTS = {'h10': (1, 1), 'h20': (2, 1), 'h30': (3, 1),
+               'serv1': (31, 1), 'hnotrust': (21, 5)}
+PART4_LINKS = [(1, 2, 21, 1), (2, 2, 21, 2), (3, 2, 21, 3), (21, 4, 31, 2)]
+
+
+# part4_topo with the rules Part4Controller compiles from p
+def part4(p, routed=False, pipeline=False, reply_only=(), queue_ports=()):
+    net = Network()
+    for dpid in (1, 2, 3, 31):
+        net.add_switch(dpid, policy.allow_all())
+    net.add_switch(21, policy.core(p, routed, '00:00:00:00:00:15', pipeline,
+                                   queue_ports),
+                   learning=not routed)
+    for a, pa, b, pb in PART4_LINKS:
+        net.add_link(a, pa, b, pb)
+    # the hosts are where the topology has them, with the addresses they
+    # really have, whatever the policy calls them
+    for name, (dpid, port) in PART4_HOSTS.items():
+        net.add_host(name, policy.IPS[name][0], dpid, port)
+    at = dict((ip, name) for name, (ip, mac) in policy.IPS.items())
+    net.reply_only = set(at[p['hosts'][h][0]] for h in reply_only
+                         if h in p['hosts'] and p['hosts'][h][0] in at)
+    return net
+
+
+# the properties a policy for part4_topo must keep
+def verify_part4(p, routed=False, pipeline=False, reply_only=(),
+                 queue_ports=()):
+    missing = ["reply-only host %s is not in the policy" % (h,)
+               for h in reply_only if h not in p['hosts']]
+    net = part4(p, routed, pipeline, reply_only, queue_ports)
+    result = Verifier(net).run()
+    return missing + check(result, net, isolated=[('hnotrust', 'serv1')],
+                           connected=['h10', 'h20', 'h30', 'serv1'])
+
+
+# a tree of fanout-ary edge switches under one learning core, per edge
+# switch one host; for timing the verifier on big topologies
+def synthetic(switches, fanout=4):
+    hosts = {}
+    net = Network()
+    core = 1000000
+    net.add_switch(core, {}, learning=True)
+    parents = [(core, 0)]
+    next_port = {core: 1}
+    made = 0
+    while made < switches:
+        nxt = []
+        for parent, _ in parents:
+            for _ in range(fanout):
+                if made >= switches:
+                    break
+                made += 1
+                dpid = made
+                net.add_switch(dpid, policy.allow_all())
+                net.add_link(parent, next_port[parent], dpid, 1)
+                next_port[parent] += 1
+                next_port[dpid] = 3
+                ip = '10.%d.%d.10' % (made // 256, made % 256)
+                name = 'h%d' % made
+                net.add_host(name, ip, dpid, 2)
+                hosts[name] = (ip, None)
+                nxt.append((dpid, 0))
+        parents = nxt
+    p = {'hosts': hosts, 'routes': [],
+         'block': [{'src': 'h1', 'dst': 'h2'}]}
+    net.add_switch(core, policy.block(p), learning=True)
+    return net
+
+
+def main(argv):
+    if '--bench' in argv:
+        n = int(argv[argv.index('--bench') + 1])
+        net = synthetic(n)
+        start = time.time()
+        result = Verifier(net).run()
+        took = time.time() - start
+        pairs = sum(1 for k, v in result.reached.items() if v)
+        print("%d switches, %d hosts: %d reachable pairs in %.2fs" %
+              (len(net.rules), len(net.hosts), pairs, took))
+        return 0
+    files = [a for a in argv if not a.startswith('--')]
+    p = policy.default(policy.IPS, policy.ROUTES)
+    if files:
+        p = policy.load(files[0], p)
+    start = time.time()
+    problems = verify_part4(p, '--routed' in argv, '--pipeline' in argv,
+                            queue_ports=(4,) if '--qos' in argv else ())
+    for line in problems:
+        print(line)
+    print("%d violations (%.1f ms)" % (len(problems),
+                                       (time.time() - start) * 1000))
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+#
+# part4_topo with redundant links (s1-s2, s3-dcs31), for the controller's
+# --failover: pings h10 -> serv1 every 10 ms, takes cores21-dcs31 down
+# and reports how long traffic was lost for.  Run the controller with
+#   ./pox.py openflow.discovery part4controller --failover
+
+import re
+import sys
+import time
+
+from mininet.net import Mininet
+from mininet.log import setLogLevel
+from mininet.cli import CLI
+from mininet.node import RemoteController
+
+from part4_github import part4_topo
+
+INTERVAL = 0.01             # seconds between pings
+
+
+class part4_failover_topo(part4_topo):
+    def build(self):
+        part4_topo.build(self)
+        # backup paths around cores21's links to s1/s2 and dcs31
+        self.addLink('s1', 's2')
+        self.addLink('s3', 'dcs31')
+
+
+topos = {'part4_failover': part4_failover_topo}
+
+
+# ping src -> dst while the link a-b goes down; returns the seconds of
+# traffic lost, by counting the missed pings
+def measure(net, src, dst, a, b, before=2.0, after=3.0):
+    h, server = net.get(src), net.get(dst)
+    count = int((before + after) / INTERVAL)
+    h.sendCmd('ping -i %s -c %d -W 1 %s' % (INTERVAL, count, server.IP()))
+    time.sleep(before)
+    net.configLinkStatus(a, b, 'down')
+    out = h.waitOutput()
+    m = re.search(r'(\d+) packets transmitted, (\d+) received', out)
+    if m is None:
+        print(out)
+        return None
+    sent, got = int(m.group(1)), int(m.group(2))
+    return (sent - got) * INTERVAL
+
+
+def configure():
+    topo = part4_failover_topo()
+    net = Mininet(topo=topo, controller=RemoteController)
+    net.start()
+
+    # let LLDP find the links and the hold down pass, then learn hosts
+    time.sleep(10)
+    net.pingAll()
+    for a, b in (('cores21', 'dcs31'), ('s1', 'cores21')):
+        lost = measure(net, 'h10', 'serv1', a, b)
+        if lost is not None:
+            print('%s-%s down: %.0f ms of h10 -> serv1 traffic lost' %
+                  (a, b, lost * 1000))
+        net.configLinkStatus(a, b, 'up')
+        time.sleep(10)                      # LLDP finds it again
+
+    if '--cli' in sys.argv:
+        CLI(net)
+    net.stop()
+
+
+if __name__ == '__main__':
+    setLogLevel('info')
+    configure()
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+#
+# tail latency of pings to serv1 while h10 and h20 push bulk TCP to it,
+# through a 10 Mbit/s cores21 -> dcs31 link; run the controller with
+#   ./pox.py part4controller --qos=4
+# and compare against a run with --same-queues, where all three queues
+# get the same share and priority
+
+import re
+import sys
+import time
+
+from mininet.net import Mininet
+from mininet.log import setLogLevel
+from mininet.node import RemoteController
+
+from part4_github import part4_topo
+
+PORT = 'cores21-eth4'       # cores21 port 4, towards dcs31
+RATE = 10 * 1000 * 1000     # bits/s out of it
+
+# queue: (min-rate, priority); policy.default puts pings and port 80 to
+# serv1 in queue 1, the rest of serv1's traffic in queue 2
+QUEUES = {0: (RATE // 10, 1),
+          1: (RATE * 3 // 10, 0),
+          2: (RATE // 10, 2)}
+
+
+# one linux-htb QoS on PORT with QUEUES; even gives them all the same
+def setup_queues(switch, even=False):
+    cmd = ['ovs-vsctl -- set port %s qos=@qos' % PORT,
+           '-- --id=@qos create qos type=linux-htb other-config:max-rate=%d'
+           % RATE + ''.join(' queues:%d=@q%d' % (q, q) for q in sorted(QUEUES))]
+    for q, (rate, prio) in sorted(QUEUES.items()):
+        if even:
+            rate, prio = RATE // len(QUEUES), 1
+        cmd.append('-- --id=@q%d create queue other-config:min-rate=%d '
+                   'other-config:max-rate=%d other-config:priority=%d'
+                   % (q, rate, RATE, prio))
+    switch.cmd(' '.join(cmd))
+
+
+def clear_queues(switch):
+    switch.cmd('ovs-vsctl -- clear port %s qos -- --all destroy qos '
+               '-- --all destroy queue' % PORT)
+
+
+# ping rtts (ms) as p50/p99/max
+def percentiles(out):
+    rtts = sorted(float(x) for x in re.findall(r'time=([\d.]+) ms', out))
+    if not rtts:
+        return None
+    at = lambda p: rtts[min(len(rtts) - 1, int(len(rtts) * p / 100.0))]
+    return at(50), at(99), rtts[-1], len(rtts)
+
+
+def configure():
+    even = '--same-queues' in sys.argv
+    topo = part4_topo()
+    net = Mininet(topo=topo, controller=RemoteController)
+    net.start()
+    setup_queues(net.get('cores21'), even)
+
+    net.pingAll()                           # learn the hosts
+    serv1 = net.get('serv1')
+    serv1.cmd('iperf -s -p 5001 &')
+    time.sleep(1)
+    idle = percentiles(net.get('h30').cmd('ping -i 0.05 -c 100 %s' %
+                                          serv1.IP()))
+    for h in ('h10', 'h20'):
+        net.get(h).cmd('iperf -c %s -p 5001 -t 30 -P 4 > /dev/null &' %
+                       serv1.IP())
+    time.sleep(3)                           # let TCP fill the queues
+    busy = percentiles(net.get('h30').cmd('ping -i 0.05 -c 400 %s' %
+                                          serv1.IP()))
+    for h in ('h10', 'h20'):
+        net.get(h).cmd('kill %iperf')
+    serv1.cmd('kill %iperf')
+
+    print('queues: %s' % ('all the same' if even else 'by class'))
+    for name, r in (('idle', idle), ('under bulk load', busy)):
+        if r is None:
+            print('%s: no replies' % name)
+        else:
+            print('%s: p50 %.2f ms, p99 %.2f ms, max %.2f ms (%d replies)'
+                  % ((name,) + r))
+
+    clear_queues(net.get('cores21'))
+    net.stop()
+
+
+if __name__ == '__main__':
+    setLogLevel('info')
+    configure()